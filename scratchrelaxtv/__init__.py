@@ -14,19 +14,161 @@ Example:
         $ scratchrelaxtv --help
 """
 
+# Imports are kept to what every run needs; the rest (process pools, json,
+# hashing, the HCL2 lexer, ...) are imported where they are used because
+# the CLI is started thousands of times from hooks and import time adds up.
+import collections
+import contextlib
+import functools
+import itertools
 import logging
-import logging.config
 import os
 import re
-
+import sys
+import time
 
 __version__ = "0.6.17"
 EXIT_OKAY = 0
 EXIT_NOT_OKAY = 1
+PARALLEL_MIN_FILES = 16
+CACHE_MAX_ENTRIES = 20000
+CACHE_MAX_DIRS = 2000
+CHECK_BATCH_FILES = 4096
+FIND_CHUNK_SIZE = 1 << 20
+MMAP_THRESHOLD = 4 * 1024 * 1024
+SNIFF_SIZE = 8192
+# byte order marks of encodings the byte scanners cannot read, longest first
+WIDE_BOMS = (
+    (b"\xff\xfe\x00\x00", "utf_32"), (b"\x00\x00\xfe\xff", "utf_32"),
+    (b"\xff\xfe", "utf_16"), (b"\xfe\xff", "utf_16"))
+
+NUMBERED_REGEX = re.compile(r'^(.*)\.(\d+)$')
+REMOVABLE_REGEX = re.compile(r'^(variables\.\d+|modstub(\.\d+|))\.tf$')
+IGNORE_DIRS = (".git", ".terraform", "node_modules")
+TF_REGEX = re.compile(r'^.*\.tf$')
+STUB_STATE_VERSION = 2
+CHECK_STATE_VERSION = 1
+
+# file systems only record mtimes so precisely; a file changed within this
+# window of being scanned could change again without its stat changing
+RACY_WINDOW_NS = 2 * 10**9
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
 
-logging.config.fileConfig(
-    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logging.conf'))
 logger = logging.getLogger(__name__)        # pylint: disable=invalid-name
+logger.addHandler(logging.NullHandler())
+
+
+def configure_logging(quiet=False, stream=None):
+    """Send log messages to stdout (or stream), as the CLI does.
+
+    Nothing is configured on import, so using scratchrelaxtv as a library
+    leaves logging to the application. With quiet, only warnings are
+    logged; info records are dropped before they are created or formatted.
+    """
+    if not any(getattr(handler, "scratchrelaxtv", False)
+               for handler in logger.handlers):
+        handler = logging.StreamHandler(stream or sys.stdout)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.scratchrelaxtv = True
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(logging.WARNING if quiet else logging.DEBUG)
+
+
+# Stats objects collecting counters for the code running now; instrumented
+# code does nothing extra when it is empty
+_COLLECTORS = []
+
+
+class Stats():
+    """
+    Counters and per-phase timings collected while scratchrelaxtv runs.
+
+    Phases are read, scan, sort, render and write. Read and scan times are
+    summed across worker processes, so with a pool they can exceed the wall
+    time of the run.
+    """
+
+    phases = ("read", "scan", "sort", "render", "write")
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(self.phases, 0.0)
+        self.files_read = 0
+        self.bytes_read = 0
+        self.matches = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def as_dict(self):
+        """Return the counters as a dict."""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "seconds": dict(self.seconds),
+            "files_read": self.files_read,
+            "bytes_read": self.bytes_read,
+            "matches": self.matches,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_hit_rate": self.cache_hits / lookups if lookups else None,
+        }
+
+    def render(self):
+        """Return the counters as a human-readable table."""
+        stats = self.as_dict()
+        lines = ["{:<14} {:>10.4f}s".format(phase, stats["seconds"][phase])
+                 for phase in self.phases]
+        lines.extend("{:<14} {:>11}".format(name, stats[name]) for name in (
+            "files_read", "bytes_read", "matches", "cache_hits",
+            "cache_misses"))
+        if stats["cache_hit_rate"] is not None:
+            lines.append("{:<14} {:>10.1f}%".format(
+                "cache_hit_rate", 100 * stats["cache_hit_rate"]))
+        return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def collect_stats():
+    """Collect Stats for the code run inside the with block.
+
+    >>> with collect_stats() as stats:
+    ...     tf_vars = extract_vars("a = var.a")
+    >>> stats.matches
+    1
+    """
+    stats = Stats()
+    _COLLECTORS.append(stats)
+    try:
+        yield stats
+    finally:
+        _COLLECTORS.remove(stats)
+
+
+def _count(**counters):
+    for stats in _COLLECTORS:
+        for name, value in counters.items():
+            setattr(stats, name, getattr(stats, name) + value)
+
+
+def _add_seconds(phase, seconds):
+    for stats in _COLLECTORS:
+        stats.seconds[phase] += seconds
+
+
+def _timed(phase):
+    """Decorate a function to add its run time to a phase of any Stats."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _COLLECTORS:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _add_seconds(phase, time.perf_counter() - start)
+        return wrapper
+    return decorator
 
 
 def remove_prefix(text, prefix):
@@ -34,14 +176,1428 @@ def remove_prefix(text, prefix):
     return text[text.startswith(prefix) and len(prefix):]
 
 
-def remove_files():
-    """Remove files from the os that look like scratchrelaxtv files."""
+def compile_excludes(patterns):
+    """Compile .gitignore-style patterns for walk_removable().
+
+    As in .gitignore, blank lines and lines starting with # are skipped, a
+    trailing / matches only directories, and a pattern containing any other
+    / is matched against the path from the root rather than the name.
+    Negation (!) is not supported.
+    """
+    import fnmatch
+    excludes = []
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith(("#", "!")):
+            continue
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        excludes.append((
+            re.compile(fnmatch.translate(pattern.lstrip("/"))),
+            dir_only,
+            anchored))
+    return excludes
+
+
+def _excluded(relpath, name, is_dir, excludes):
+    for regex, dir_only, anchored in excludes:
+        if (is_dir or not dir_only)\
+                and regex.match(relpath if anchored else name):
+            return True
+    return False
+
+
+def _scan_dir(path, relpath, regex, ignore_dirs, excludes):
+    """List the matching files and subdirectories to descend into."""
+    files, subdirs = [], []
+    try:
+        entries = list(os.scandir(path))
+    except OSError as err:
+        logger.warning("could not list %s: %s", path, err)
+        return files, subdirs
+    for entry in entries:
+        entry_relpath = "/".join([relpath, entry.name]) if relpath\
+            else entry.name
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name not in ignore_dirs and not _excluded(
+                    entry_relpath, entry.name, True, excludes):
+                subdirs.append((entry.path, entry_relpath))
+        elif regex.match(entry.name) and not _excluded(
+                entry_relpath, entry.name, False, excludes):
+            files.append(entry.path)
+    return files, subdirs
+
+
+def walk_files(regex, root=None, ignore_dirs=IGNORE_DIRS, excludes=(),
+               jobs=None):
+    """Yield files under root whose names match regex as they are found.
+
+    Directories named in ignore_dirs, or matching the .gitignore-style
+    excludes, are pruned rather than walked. Directories are listed on a
+    pool of jobs threads, so results are not yielded in any fixed order.
+    """
+    import concurrent.futures
+    root = root or os.getcwd()
+    excludes = compile_excludes(excludes)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        pending = {executor.submit(
+            _scan_dir, root, "", regex, ignore_dirs, excludes)}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                pending.update(
+                    executor.submit(
+                        _scan_dir, path, relpath, regex, ignore_dirs,
+                        excludes)
+                    for path, relpath in subdirs)
+                yield from files
+
+
+def walk_removable(root=None, ignore_dirs=IGNORE_DIRS, excludes=(),
+                   jobs=None):
+    """Yield scratchrelaxtv files under root as they are found."""
+    return walk_files(REMOVABLE_REGEX, root, ignore_dirs, excludes, jobs)
+
+
+def find_module_dirs(roots, ignore_dirs=IGNORE_DIRS, excludes=(),
+                     jobs=None):
+    """Return every directory under roots holding .tf files, sorted."""
+    return sorted({
+        os.path.dirname(filename)
+        for root in roots
+        for filename in walk_files(
+            TF_REGEX, root, ignore_dirs, excludes, jobs)})
+
+
+def changed_files(root=None, since=None, staged=False):
+    """Return the files under root that git reports as changed.
+
+    With staged, these are the files staged for commit. Otherwise they are
+    the files changed in the working tree since the commit since (HEAD if
+    None), plus untracked files that are not ignored. Deleted files are
+    included. Raises OSError if git cannot be run or fails.
+    """
+    import subprocess
+    root = root or os.curdir
+    commands = [["git", "diff", "--name-only", "-z", "--relative"]
+                + (["--cached"] if staged else [since or "HEAD"]) + ["--"]]
+    if not staged:
+        commands.append(
+            ["git", "ls-files", "--others", "--exclude-standard", "-z"])
+    names = []
+    for command in commands:
+        try:
+            output = subprocess.run(
+                command, cwd=root, check=True, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE).stdout
+        except subprocess.CalledProcessError as err:
+            raise OSError(err.stderr.decode("utf_8", "replace").strip()
+                          or str(err))
+        names.extend(name for name in output.decode(
+            "utf_8", "surrogateescape").split("\0") if name)
+    return [os.path.normpath(os.path.join(root, name))
+            for name in dict.fromkeys(names)]
+
+
+def changed_module_dirs(roots, since=None, staged=False,
+                        ignore_dirs=IGNORE_DIRS):
+    """Return the module directories under roots holding changed files.
+
+    A changed .tf file belongs to its own directory; any other changed
+    file, such as a template, to the nearest directory above it, up to its
+    root, that holds .tf files.
+    """
+    module_dirs = set()
+    for root in roots:
+        top = os.path.abspath(root)
+        for filename in changed_files(root, since, staged):
+            directory = os.path.dirname(filename) or os.curdir
+            if set(directory.split(os.sep)) & set(ignore_dirs):
+                continue
+            while not TF_REGEX.match(filename)\
+                    and not find_input_files([directory]):
+                parent = os.path.dirname(directory) or os.curdir
+                if os.path.abspath(directory) == top or parent == directory:
+                    break
+                directory = parent
+            module_dirs.add(directory)
+    return sorted(directory for directory in module_dirs
+                  if find_input_files([directory]))
+
+
+def remove_files(root=None, ignore_dirs=IGNORE_DIRS, excludes=(),
+                 dry_run=False, jobs=None):
+    """Remove files from the os that look like scratchrelaxtv files.
+
+    With dry_run, nothing is removed. Returns the files removed (or that
+    would be).
+    """
     logger.info("attempting removal of files")
-    pattern = r'^(variables\.\d+|modstub(\.\d+|))\.tf$'
-    for root, _, files in os.walk(os.getcwd()):
-        for file in filter(lambda x: re.match(pattern, x), files):
-            os.remove(os.path.join(root, file))
-            logger.info("removed file: %s", os.path.join(root, file))
+    removed = []
+    for path in walk_removable(root, ignore_dirs, excludes, jobs):
+        if not dry_run:
+            os.remove(path)
+            logger.info("removed file: %s", path)
+        removed.append(path)
+    return removed
+
+
+@functools.lru_cache(maxsize=None)
+def compiled(regex, flags=0):
+    """Return regex compiled, compiling each pattern only once.
+
+    Unlike re.compile(), this cache is never cleared, however many patterns
+    a run uses.
+    """
+    return re.compile(regex, flags)
+
+
+def natural_key(name):
+    """Return a sort key that orders the numbers in name by value.
+
+    >>> sorted(["var10", "var2", "var1"], key=natural_key)
+    ['var1', 'var2', 'var10']
+    """
+    return [int(part) if index % 2 else part
+            for index, part in enumerate(compiled(r'(\d+)').split(name))]
+
+
+def find_input_files(dirs, pattern="*.tf"):
+    """Return files matching pattern in each directory, in a stable order.
+
+    A "**" in pattern matches any number of subdirectories.
+    """
+    import glob
+    input_files = []
+    for directory in dirs:
+        # a pattern also matches directories, e.g. one named "old.tf"
+        input_files.extend(sorted(filter(os.path.isfile, glob.glob(
+            os.path.join(directory, pattern), recursive=True))))
+    return list(dict.fromkeys(input_files))
+
+
+# A single scanner finds every kind of reference in one pass over a file.
+# In HCL, comments are matched (and dropped) so that their contents cannot
+# produce references. So are quoted strings and heredocs, so that "#",
+# "//" and "/*" inside them are not taken for comments; their contents
+# are then scanned for references (0.11-style "${var.x}" interpolation
+# lives inside them) by the scanner's QUOTED_SCANNERS entry, which has no
+# comments. A comment must start a line or follow whitespace. Each scanner
+# starts with a lookahead for the first characters its alternatives can
+# match, so that most positions are rejected by one character class test
+# instead of by every alternative and lookbehind in turn (about 4x faster
+# on typical files).
+HCL_COMMENT = r'(?P<comment>(?<!\S)(?:#|//)[^\n]*|(?<!\S)/\*.*?\*/)'
+# a string, whose ${...} and %{...} may hold strings of their own, or a
+# heredoc, up to the line with its closing tag
+HCL_QUOTED = (
+    r'(?P<quoted>"(?:[^"\\\n$%]|\\.'
+    r'|[$%]\{(?:[^{}"\n]|"(?:[^"\\\n]|\\.)*")*\}|[$%](?!\{))*"'
+    r'|<<-?[ \t]*(?P<tag>[a-zA-Z_][a-zA-Z0-9_-]*)[ \t]*\r?\n'
+    r'.*?^[ \t]*(?P=tag)[ \t]*\r?$)')
+HCL_REFERENCES = (
+    r'\bvar\.(?P<var>[a-zA-Z][a-zA-Z0-9_-]*)\b'
+    r'|\blocal\.(?P<local>[a-zA-Z][a-zA-Z0-9_-]*)\b'
+    r'|\bmodule\.(?P<module>[a-zA-Z][a-zA-Z0-9_-]*'
+    r'(?:\.[a-zA-Z][a-zA-Z0-9_-]*)?)\b')
+HCL_DECLARATION = r'\bvariable\s+"(?P<variable>[^"]+)"'
+
+
+def _hcl_scanners(first, references, declarations):
+    """Return an HCL scanner and its scanner for quoted text.
+
+    first is the characters the references and declarations can start
+    with.
+    """
+    return (
+        re.compile(
+            r'(?=[#/"<{}])(?:{}|{}|{}|{})'.format(
+                first, HCL_COMMENT, HCL_QUOTED, references, declarations),
+            re.DOTALL | re.MULTILINE),
+        re.compile(r'(?=[{}])(?:{})'.format(first, references)))
+
+
+SCANNERS = {}
+QUOTED_SCANNERS = {}
+SCANNERS["hcl"], QUOTED_SCANNERS["hcl"] = _hcl_scanners(
+    "vlm", HCL_REFERENCES, HCL_DECLARATION)
+SCANNERS.update({
+    # ${name} interpolations, with optional ~ strip markers, and the
+    # variable an %{if} or %{for ... in} directive reads; $${ and %%{ are
+    # escapes
+    "template": re.compile(
+        r'(?=[$%])(?:'
+        r'(?<!\$)\${~?[ \t]*(?=[a-zA-Z][a-zA-Z0-9_-]+[ \t]*~?})'
+        r'|(?<!%)%{~?[ \t]*(?:if|for[ \t]+[a-zA-Z_][a-zA-Z0-9_-]*'
+        r'(?:[ \t]*,[ \t]*[a-zA-Z_][a-zA-Z0-9_-]*)?[ \t]+in)[ \t]+)'
+        r'(?P<template>[a-zA-Z][a-zA-Z0-9_-]+)'),
+})
+# names a template's %{for} directives bind, which are not template vars
+TEMPLATE_BOUND = re.compile(
+    r'(?<!%)%{~?[ \t]*for[ \t]+([a-zA-Z_][a-zA-Z0-9_-]*)'
+    r'(?:[ \t]*,[ \t]*([a-zA-Z_][a-zA-Z0-9_-]*))?[ \t]+in[ \t]')
+BYTES_TEMPLATE_BOUND = re.compile(
+    TEMPLATE_BOUND.pattern.encode("ascii"), TEMPLATE_BOUND.flags & ~re.UNICODE)
+SCAN_KINDS = {
+    "hcl": ("var", "variable", "local", "module"),
+    "template": ("template",),
+}
+KIND_SYNTAX = {
+    kind: syntax for syntax, kinds in SCAN_KINDS.items() for kind in kinds}
+
+# "hcl2" scans with the HCL2 lexer instead of the regex scanner
+SCAN_KINDS["hcl2"] = SCAN_KINDS["hcl"]
+
+# "typed" is "hcl" that also notes, in the same pass, how each var is used:
+# as a count or for_each, indexed, with an attribute or as a condition
+SCANNERS["typed"], QUOTED_SCANNERS["typed"] = _hcl_scanners(
+    "vlmcf",
+    r'\bcount[ \t]*=[ \t]*var\.(?P<count>[a-zA-Z][a-zA-Z0-9_-]*)\b'
+    r'(?![ \t]*[?.[])'
+    r'|\bfor_each[ \t]*=[ \t]*var\.(?P<for_each>[a-zA-Z][a-zA-Z0-9_-]*)\b'
+    r'(?![ \t]*[?.[])'
+    r'|\bvar\.(?P<var>[a-zA-Z][a-zA-Z0-9_-]*)\b'
+    r'(?:(?P<index>\[[ \t]*[0-9])|(?P<key>\[)(?=[ \t]*")'
+    r'|\.(?P<attribute>[a-zA-Z_][a-zA-Z0-9_-]*)|(?P<condition>[ \t]*\?))?'
+    r'|\blocal\.(?P<local>[a-zA-Z][a-zA-Z0-9_-]*)\b'
+    r'|\bmodule\.(?P<module>[a-zA-Z][a-zA-Z0-9_-]*'
+    r'(?:\.[a-zA-Z][a-zA-Z0-9_-]*)?)\b',
+    HCL_DECLARATION)
+SCAN_KINDS["typed"] = SCAN_KINDS["hcl"]
+
+# "module" is "hcl" that also notes, in the same pass, the providers whose
+# resources, data sources or configurations a module has (the provider of
+# "aws_s3_bucket" is "aws") and the paths of the templates it renders
+SCANNERS["module"], QUOTED_SCANNERS["module"] = _hcl_scanners(
+    "vlmrdpt",
+    HCL_REFERENCES + r'|\btemplatefile\(\s*"(?P<templatefile>[^"]+)"',
+    HCL_DECLARATION + r'|\b(?:resource|data|provider)\s+"'
+    r'(?P<provider>[a-zA-Z][a-zA-Z0-9-]*)[^"\n]*"')
+SCAN_KINDS["module"] = SCAN_KINDS["hcl"] + ("provider", "templatefile")
+KIND_SYNTAX.update(provider="module", templatefile="module")
+# providers every configuration has without declaring them
+BUILTIN_PROVIDERS = ("terraform",)
+DEFAULT_PROVIDERS = ("aws",)
+# the type each use suggests, by the scanner group that matches it
+TYPE_HINTS = {
+    "count": "number", "for_each": "map", "index": "list", "key": "map",
+    "attribute": "object", "condition": "bool"}
+# the type and default declared for each hint
+TYPE_DECLARATIONS = {
+    "string": ("string", '""'), "number": ("number", "0"),
+    "bool": ("bool", "false"), "list": ("list(any)", "[]"),
+    "map": ("map(any)", "{}"), "object": ("object({{{}}})", "null")}
+BYTES_SCANNERS = {
+    syntax: re.compile(
+        scanner.pattern.encode("ascii"), scanner.flags & ~re.UNICODE)
+    for syntax, scanner in SCANNERS.items()}
+BYTES_QUOTED_SCANNERS = {
+    syntax: re.compile(
+        scanner.pattern.encode("ascii"), scanner.flags & ~re.UNICODE)
+    for syntax, scanner in QUOTED_SCANNERS.items()}
+
+
+def scan(haystack, syntax="hcl"):
+    """Return all references in haystack, by kind, in first-seen order.
+
+    haystack may be a str or any bytes-like object, including an mmap, in
+    which case the matched names are decoded as UTF-8.
+    """
+    refs, matches = _scan(haystack, syntax)
+    _count(matches=matches)
+    return refs
+
+
+def _scan(haystack, syntax):
+    """Return the references in haystack and the number of matches."""
+    if syntax == "hcl2":
+        from scratchrelaxtv import hcl
+        if not isinstance(haystack, str):
+            haystack = bytes(haystack).decode("utf_8", "replace")
+        refs = hcl.scan(haystack)
+        return refs, sum(len(names) for names in refs.values())
+    if isinstance(haystack, str):
+        scanner, decode = SCANNERS[syntax], None
+        quoted = QUOTED_SCANNERS.get(syntax)
+    else:
+        scanner, decode = BYTES_SCANNERS[syntax], "utf_8"
+        quoted = BYTES_QUOTED_SCANNERS.get(syntax)
+    if syntax == "typed":
+        return _scan_typed(haystack, scanner, quoted, decode)
+    refs = {kind: {} for kind in SCAN_KINDS[syntax]}
+    matches = 0
+    for match in _matches(haystack, scanner, quoted):
+        kind = match.lastgroup
+        refs[kind][match.group(kind)] = None
+        matches += 1
+    if syntax == "template" and refs["template"]:
+        bound = BYTES_TEMPLATE_BOUND if decode else TEMPLATE_BOUND
+        for names in bound.findall(haystack):
+            for name in names:
+                refs["template"].pop(name, None)
+    if decode:
+        return {kind: [name.decode(decode, "replace") for name in names]
+                for kind, names in refs.items()}, matches
+    return {kind: list(names) for kind, names in refs.items()}, matches
+
+
+def _matches(haystack, scanner, quoted):
+    """Yield the references scanner and, in quoted text, quoted match."""
+    for match in scanner.finditer(haystack):
+        kind = match.lastgroup
+        if kind == "quoted":
+            yield from quoted.finditer(haystack, match.start(), match.end())
+        elif kind != "comment":
+            yield match
+
+
+def _scan_typed(haystack, scanner, quoted, decode):
+    """Return the references in haystack, with type hints, and matches.
+
+    Besides the kinds of references, the refs hold "types", the hint of
+    the first use of each var that suggests one, and "attributes", the
+    attributes used of each var.
+    """
+    refs = {kind: {} for kind in SCAN_KINDS["typed"]}
+    uses = refs["var"]
+    types = {}
+    attributes = {}
+    matches = 0
+    for match in _matches(haystack, scanner, quoted):
+        group = match.lastgroup
+        matches += 1
+        hint = TYPE_HINTS.get(group)
+        if hint is None:
+            refs[group][match.group(group)] = None
+            continue
+        name = match.group("var") or match.group(group)
+        uses[name] = None
+        types.setdefault(name, hint)
+        if hint == "object":
+            attributes.setdefault(name, {})[match.group(group)] = None
+
+    text = functools.partial(
+        bytes.decode, encoding=decode, errors="replace") if decode else str
+    refs = {kind: [text(name) for name in names]
+            for kind, names in refs.items()}
+    refs["types"] = {text(name): hint for name, hint in types.items()}
+    refs["attributes"] = {
+        text(name): [text(attribute) for attribute in names]
+        for name, names in attributes.items()}
+    return refs, matches
+
+
+def merge_types(file_refs):
+    """Return the type and default to declare each var with, by name.
+
+    Only vars whose uses, across the files' "typed" refs, suggest a type
+    other than string are included. The first suggestion wins.
+    """
+    types = {}
+    attributes = {}
+    for refs in file_refs:
+        for name, hint in refs.get("types", {}).items():
+            types.setdefault(name, hint)
+        for name, names in refs.get("attributes", {}).items():
+            attributes.setdefault(name, {}).update(dict.fromkeys(names))
+    declarations = {}
+    for name, hint in types.items():
+        type_expr, default = TYPE_DECLARATIONS[hint]
+        if hint == "object":
+            type_expr = type_expr.format(", ".join(
+                "{} = any".format(attribute)
+                for attribute in attributes[name]))
+        declarations[name] = (type_expr, default)
+    return declarations
+
+
+def sniff_encoding(head):
+    """Return how to read a file that starts with head.
+
+    Returns "binary" for a file with a NUL byte (and no wide byte order
+    mark) in head, the codec for a UTF-16 or UTF-32 byte order mark, or
+    None for anything the byte scanners read directly (UTF-8, with or
+    without a BOM, ASCII and Latin-1, whose names are ASCII anyway).
+
+    >>> sniff_encoding(b"\\xff\\xfeh\\x00"), sniff_encoding(b"\\x7fELF\\x00")
+    ('utf_16', 'binary')
+    """
+    for bom, encoding in WIDE_BOMS:
+        if head.startswith(bom):
+            return encoding
+    if b"\0" in head:
+        return "binary"
+    return None
+
+
+def _scan_path(filename, syntax, known_digest=None):
+    """Scan a single file (module level so it can be pickled).
+
+    Files are scanned as bytes, without decoding, unless they start with a
+    UTF-16 or UTF-32 byte order mark. Binary files are not scanned at all,
+    and only their first SNIFF_SIZE bytes are read.
+    Files of MMAP_THRESHOLD bytes or more are memory-mapped rather than
+    read, so memory use stays flat however large they are, and matches need
+    no chunk stitching.
+
+    Returns the references along with the file's stat and content digest so
+    the caller can cache them, and (read seconds, scan seconds, matches)
+    for Stats. If the digest matches known_digest, the scan is skipped and
+    None is returned in place of the references.
+    """
+    import hashlib
+    start = time.perf_counter()
+    scanned = start
+    matches = 0
+    with open(filename, "rb") as file_handle:
+        stat = os.fstat(file_handle.fileno())
+        head = file_handle.read(SNIFF_SIZE)
+        encoding = sniff_encoding(head)
+        mapped = encoding != "binary" and stat.st_size >= MMAP_THRESHOLD
+        if encoding == "binary":
+            # skipped without reading the rest, hashing or decoding
+            contents = head
+        elif mapped:
+            import mmap
+            contents = mmap.mmap(
+                file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            contents = head + file_handle.read()
+        try:
+            if encoding == "binary":
+                digest = encoding
+            else:
+                digest = hashlib.sha1(contents).hexdigest()
+            refs = None
+            scanned = time.perf_counter()
+            if digest == known_digest:
+                pass
+            elif encoding == "binary":
+                refs = {kind: [] for kind in SCAN_KINDS[syntax]}
+            elif encoding:
+                refs, matches = _scan(
+                    bytes(contents).decode(encoding, "replace"), syntax)
+            else:
+                refs, matches = _scan(contents, syntax)
+        finally:
+            if mapped:
+                contents.close()
+    counters = (scanned - start, time.perf_counter() - scanned, matches)
+    return refs, stat.st_size, stat.st_mtime_ns, digest, counters
+
+
+def scan_files(filenames, syntax="hcl", jobs=None, cache=None):
+    """Scan many files, returning their references in the order given.
+
+    Files are scanned on a process pool when there are enough of them to
+    outweigh the cost of starting workers. Files whose cache entry is still
+    valid are not read at all.
+    """
+    results = {}
+    to_scan = []
+    for filename in filenames:
+        refs = cache.lookup(filename, syntax) if cache else None
+        if refs is None:
+            to_scan.append(filename)
+        else:
+            results[filename] = refs
+
+    digests = [cache.digest(filename, syntax) if cache else None
+               for filename in to_scan]
+    if jobs == 1 or len(to_scan) < PARALLEL_MIN_FILES:
+        scans = [_scan_path(filename, syntax, digest)
+                 for filename, digest in zip(to_scan, digests)]
+    else:
+        import concurrent.futures
+        workers = jobs or os.cpu_count() or 1
+        chunksize = max(1, len(to_scan) // (workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            scans = list(executor.map(
+                _scan_path,
+                to_scan,
+                itertools.repeat(syntax),
+                digests,
+                chunksize=chunksize))
+
+    for filename, scanned in zip(to_scan, scans):
+        results[filename] = _record_scan(filename, syntax, scanned, cache)
+
+    _count(cache_hits=len(filenames) - len(to_scan))
+
+    return [results[filename] for filename in filenames]
+
+
+def _record_scan(filename, syntax, scanned, cache):
+    """Count a _scan_path() result and cache it; return its refs."""
+    refs, size, mtime, digest, counters = scanned
+    if _COLLECTORS:
+        _add_seconds("read", counters[0])
+        _add_seconds("scan", counters[1])
+        # only the head of a binary file is read
+        _count(files_read=1, bytes_read=min(size, SNIFF_SIZE)
+               if digest == "binary" else size, matches=counters[2],
+               cache_hits=int(refs is None),
+               cache_misses=int(cache is not None and refs is not None))
+    if cache:
+        refs = cache.store(filename, syntax, refs, size, mtime, digest)
+    return refs
+
+
+def read_chunks(stream, size=FIND_CHUNK_SIZE):
+    """Yield the text of stream as it arrives, in chunks of up to size.
+
+    Unlike stream.read(size), this does not wait for size characters when
+    a pipe has fewer to give so far.
+    """
+    import codecs
+    buffer = getattr(stream, "buffer", None)
+    if not hasattr(buffer, "read1"):
+        yield from iter(functools.partial(stream.read, size), "")
+        return
+    decoder = codecs.getincrementaldecoder(
+        getattr(stream, "encoding", None) or "utf_8")("replace")
+    for data in iter(functools.partial(buffer.read1, size), b""):
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+# the start of a /* comment, where the scanners see comments
+COMMENT_OPEN = re.compile(r'(?<!\S)/\*')
+# the start of a heredoc, whose tag is group 1
+HEREDOC_OPEN = re.compile(
+    r'<<-?[ \t]*([a-zA-Z_][a-zA-Z0-9_-]*)[ \t]*\r?$', re.MULTILINE)
+
+
+def scan_stream(chunks, syntax="hcl"):
+    """Yield the scan() refs of text arriving in chunks, as it arrives.
+
+    Text is scanned once the line it ends on is complete, so no name is
+    split between two scans, and from an unterminated /* comment on only
+    once the comment ends, so vars commented out are not taken for uses.
+    Likewise, an unterminated heredoc waits for its closing tag. Each
+    yield has the refs of the text since the one before.
+
+    >>> [refs["var"] for refs in scan_stream(
+    ...     ["a = var.a\\n/* var.", "b\\n */ c = var.c", "\\n"])]
+    [['a'], ['c']]
+    """
+    pending = ""
+    held = False
+    for chunk in chunks:
+        start = len(pending)
+        pending += chunk
+        if held:
+            # any */ must be in the new text (but not the opening /*)
+            if "*/" not in pending[max(2, start - 1):]:
+                continue
+            held = False
+        end = pending.rfind("\n") + 1
+        closed = pending.rfind("*/", 0, end)
+        opened = COMMENT_OPEN.search(
+            pending, closed + 2 if closed >= 0 else 0, end)
+        if opened:
+            end = opened.start()
+            held = "*/" not in pending[end + 2:]
+        for opened in HEREDOC_OPEN.finditer(pending, 0, end):
+            if not compiled(r'^[ \t]*{}[ \t]*\r?$'.format(
+                    re.escape(opened.group(1))), re.MULTILINE).search(
+                        pending, opened.end(), end):
+                end = opened.start()
+                break
+        if end:
+            text, pending = pending[:end], pending[end:]
+            yield scan(text, syntax)
+    if pending:
+        yield scan(pending, syntax)
+
+
+def read_file_list(filename):
+    """Return the file names in a NUL-delimited list in filename.
+
+    Such lists come from e.g. git ls-files -z or find -print0. filename "-"
+    means stdin.
+    """
+    if filename == "-":
+        data = sys.stdin.buffer.read()
+    else:
+        with open(filename, "rb") as file_handle:
+            data = file_handle.read()
+    return [os.fsdecode(name) for name in data.split(b"\0") if name]
+
+
+def merge_refs(file_refs, kind):
+    """Merge one kind of reference from many files, in first-seen order."""
+    return list(dict.fromkeys(itertools.chain.from_iterable(
+        refs[kind] for refs in file_refs)))
+
+
+def find_vars_in_files(filenames, kind="var", jobs=None, cache=None,
+                       syntax=None):
+    """Extract one kind of reference from many files, in first-seen order."""
+    return merge_refs(
+        scan_files(filenames, syntax or KIND_SYNTAX[kind], jobs, cache), kind)
+
+
+def default_cache_dir():
+    """Return the directory the vars cache lives in by default."""
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME")
+        or os.path.join(os.path.expanduser("~"), ".cache"),
+        "scratchrelaxtv")
+
+
+@functools.lru_cache(maxsize=None)
+def cache_version():
+    """Return a digest of this version of scratchrelaxtv and its scanners.
+
+    Refs cached under any other digest are not used, so upgrading, or
+    changing a scanner's pattern, rescans files whose stat is unchanged.
+    """
+    import hashlib
+    digest = hashlib.sha1(__version__.encode("utf_8"))
+    for scanners in (SCANNERS, QUOTED_SCANNERS):
+        for syntax in sorted(scanners):
+            digest.update(scanners[syntax].pattern.encode("utf_8"))
+    return digest.hexdigest()
+
+
+class VarCache():
+    """
+    An on-disk cache of the references scanned from each file.
+
+    Entries are keyed by absolute path and hold the size, mtime and content
+    digest of the file along with its references, by syntax. An entry
+    whose size and mtime still match is used without reading the file; one
+    whose stat changed but whose digest matches is used without rescanning.
+
+    Each directory's entries are kept in a small file of their own, read
+    when a file in the directory is first looked up and rewritten only
+    when one of them changes, so a run over a few files costs the same
+    however many are cached. The least recently used entries of a
+    directory are evicted past max_entries, and the least recently used
+    directories past max_dirs.
+    """
+
+    dirname = "vars"
+
+    def __init__(self, cache_dir=None, max_entries=CACHE_MAX_ENTRIES,
+                 max_dirs=CACHE_MAX_DIRS):
+        self.path = os.path.join(
+            cache_dir or default_cache_dir(), self.dirname)
+        self.max_entries = max_entries
+        self.max_dirs = max_dirs
+        self.shards = {}
+        self.dirty = set()
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def entries(self):
+        """The entries read or stored so far, by path."""
+        entries = collections.OrderedDict()
+        for shard in self.shards.values():
+            entries.update(shard)
+        return entries
+
+    def _shard_path(self, directory):
+        import hashlib
+        return os.path.join(self.path, hashlib.sha1(
+            os.fsencode(directory)).hexdigest() + ".json")
+
+    def _shard(self, directory):
+        shard = self.shards.get(directory)
+        if shard is not None:
+            return shard
+        import json
+        shard = self.shards[directory] = collections.OrderedDict()
+        try:
+            with open(self._shard_path(directory), "r",
+                      encoding="utf_8") as file_handle:
+                cached = json.load(file_handle)
+        except (OSError, ValueError):
+            return shard
+        if cached.get("version") == cache_version() and cached.get(
+                "directory") == directory:
+            shard.update(cached.get("entries", []))
+        return shard
+
+    def _entry(self, filename):
+        key = os.path.abspath(filename)
+        directory = os.path.dirname(key)
+        shard = self._shard(directory)
+        entry = shard.get(key)
+        if entry is not None:
+            self.used.add(directory)
+            if next(reversed(shard)) != key:
+                shard.move_to_end(key)
+                self.dirty.add(directory)
+        return entry
+
+    def lookup(self, filename, syntax):
+        """Return cached refs if the file's stat is unchanged, else None."""
+        entry = self._entry(filename)
+        if entry is None or syntax not in entry["refs"]:
+            return None
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        if (stat.st_size, stat.st_mtime_ns) != (entry["size"], entry["mtime"])\
+                or entry["mtime"] + RACY_WINDOW_NS > entry["scanned"]:
+            return None
+        self.hits += 1
+        return entry["refs"][syntax]
+
+    def digest(self, filename, syntax):
+        """Return the digest the cached refs for a file were found in."""
+        entry = self._entry(filename)
+        if entry is None or syntax not in entry["refs"]:
+            return None
+        return entry["digest"]
+
+    def store(self, filename, syntax, refs, size, mtime, digest):
+        """Record a scan and return its refs.
+
+        refs of None means the digest matched the cached entry and the
+        cached refs are still current.
+        """
+        key = os.path.abspath(filename)
+        directory = os.path.dirname(key)
+        shard = self._shard(directory)
+        entry = shard.get(key)
+        if refs is None:
+            self.hits += 1
+            refs = entry["refs"][syntax]
+        else:
+            self.misses += 1
+            if entry is None or entry["digest"] != digest:
+                entry = {"refs": {}}
+            entry["refs"][syntax] = refs
+
+        entry.update({
+            "size": size,
+            "mtime": mtime,
+            "digest": digest,
+            "scanned": int(time.time() * 10**9)})
+        shard[key] = entry
+        shard.move_to_end(key)
+        while len(shard) > self.max_entries:
+            shard.popitem(last=False)
+        self.dirty.add(directory)
+
+        return refs
+
+    def save(self):
+        """Write the changed directories' entries to disk, atomically.
+
+        The files of directories only looked up are touched, so that their
+        mtimes say when they were last used.
+        """
+        import json
+        import tempfile
+        created = False
+        for directory in sorted(self.dirty):
+            path = self._shard_path(directory)
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                created = created or not os.path.exists(path)
+                with tempfile.NamedTemporaryFile(
+                        "w", encoding="utf_8", dir=self.path,
+                        delete=False) as file_handle:
+                    json.dump({
+                        "version": cache_version(),
+                        "directory": directory,
+                        "entries": list(self.shards[directory].items())},
+                        file_handle)
+                os.replace(file_handle.name, path)
+            except OSError as err:
+                logger.warning("could not save cache %s: %s", path, err)
+                return
+        for directory in self.used - self.dirty:
+            with contextlib.suppress(OSError):
+                os.utime(self._shard_path(directory))
+        self.dirty.clear()
+        self.used.clear()
+        if created:
+            self._evict()
+
+    def _evict(self):
+        try:
+            shards = sorted(
+                (entry for entry in os.scandir(self.path)
+                 if entry.name.endswith(".json")),
+                key=lambda entry: entry.stat().st_mtime_ns)
+            for entry in shards[:max(0, len(shards) - self.max_dirs)]:
+                os.remove(entry.path)
+            # the single file earlier versions kept every entry in
+            os.remove(os.path.join(os.path.dirname(self.path), "vars.json"))
+        except OSError:
+            pass
+
+
+CheckResult = collections.namedtuple("CheckResult", "missing unused")
+
+
+def _syntax_for(kind, parser, infer=False):
+    syntax = KIND_SYNTAX[kind]
+    if syntax == "hcl" and parser == "hcl":
+        return "hcl2"
+    if syntax == "hcl" and infer:
+        return "typed"
+    return syntax
+
+
+@_timed("sort")
+def _sorted(tf_vars, order, natural=False):
+    key = natural_key if natural else None
+    if order == "asc":
+        tf_vars.sort(key=key)
+    elif order == "desc":
+        tf_vars.sort(key=key, reverse=True)
+    return tf_vars
+
+
+def extract_vars(text=None, paths=(), kind="var", parser="regex",
+                 order=None, jobs=None, cache=None, natural=False):
+    """Return the vars of one kind found in text and/or files.
+
+    Vars are in first-seen order (text first, then paths in order) unless
+    order is "asc" or "desc"; with natural, numbers in names sort by value
+    ("var2" before "var10"). kind is "var" (uses), "variable"
+    (declarations), "local", "module" or "template".
+
+    >>> extract_vars('bucket = var.bucket\\nregion = var.region')
+    ['bucket', 'region']
+    """
+    syntax = _syntax_for(kind, parser)
+    file_refs = scan_files(list(paths), syntax, jobs, cache)
+    if text is not None:
+        file_refs.insert(0, scan(text, syntax))
+    return _sorted(merge_refs(file_refs, kind), order, natural)
+
+
+def check_vars(text=None, paths=(), variables_text=None,
+               variables_paths=None, parser="regex", jobs=None, cache=None):
+    """Compare the vars used in text/paths with those declared.
+
+    Declarations are taken from variables_text and variables_paths, or, if
+    neither is given, from the same text and paths as the uses. Returns a
+    CheckResult of the vars used but not declared (missing) and declared
+    but not used (unused), each in first-seen order.
+    """
+    from scratchrelaxtv import names
+    used = extract_vars(text, paths, "var", parser, jobs=jobs, cache=cache)
+    if variables_text is None and variables_paths is None:
+        variables_text, variables_paths = text, paths
+    declared = extract_vars(
+        variables_text, variables_paths or (), "variable", parser,
+        jobs=jobs, cache=cache)
+    table = names.NameTable()
+    return CheckResult(*table.compare([table.postings(used, declared)]))
+
+
+def _module_batches(module_dirs):
+    """Yield OrderedDicts of module directory to .tf files.
+
+    Each holds whole modules and, unless one module alone has more, at
+    most CHECK_BATCH_FILES files.
+    """
+    batch = collections.OrderedDict()
+    files = 0
+    for module_dir in module_dirs:
+        filenames = find_input_files([module_dir])
+        if batch and files + len(filenames) > CHECK_BATCH_FILES:
+            yield batch
+            batch = collections.OrderedDict()
+            files = 0
+        batch[module_dir] = filenames
+        files += len(filenames)
+    if batch:
+        yield batch
+
+
+def check_modules(module_dirs, syntax="hcl", jobs=None, cache=None):
+    """Check each module directory's uses against its declarations.
+
+    The .tf files of many modules are scanned together, so the worker pool
+    fans out over up to CHECK_BATCH_FILES of them at once. Each file's
+    references are then reduced to postings in one NameTable shared by
+    the whole repository (see scratchrelaxtv.names), so memory grows with
+    the number of distinct names rather than of references. Returns an
+    OrderedDict of module directory to CheckResult.
+    """
+    from scratchrelaxtv import names
+    table = names.NameTable()
+    results = collections.OrderedDict()
+    for batch in _module_batches(module_dirs):
+        all_files = list(itertools.chain.from_iterable(batch.values()))
+        file_postings = {
+            filename: table.postings(refs["var"], refs["variable"])
+            for filename, refs in zip(
+                all_files, scan_files(all_files, syntax, jobs, cache))}
+        for module_dir, filenames in batch.items():
+            results[module_dir] = CheckResult(*table.compare(
+                [file_postings[filename] for filename in filenames]))
+    return results
+
+
+ModuleInfo = collections.namedtuple(
+    "ModuleInfo", "fingerprint inputs required calls providers")
+
+
+def _module_files(module_dir):
+    # generated stubs and numbered outputs are not part of the module
+    return [filename for filename in find_input_files([module_dir])
+            if not REMOVABLE_REGEX.match(os.path.basename(filename))]
+
+
+def _fingerprint(filenames):
+    """Return a digest of the names, sizes and mtimes of filenames."""
+    import hashlib
+    digest = hashlib.sha1()
+    for filename in filenames:
+        stat = os.stat(filename)
+        digest.update("{}\0{}\0{}\n".format(
+            filename, stat.st_size, stat.st_mtime_ns).encode(
+                "utf_8", "surrogateescape"))
+    return digest.hexdigest()
+
+
+def read_module(module_dir, fingerprint=None):
+    """Return the ModuleInfo of the module in module_dir.
+
+    inputs are the declared variables, required those without a default,
+    calls a [name, source, arguments] list for each module block, and
+    providers those the module uses (see module_providers()).
+    """
+    from scratchrelaxtv import hcl
+    filenames = _module_files(module_dir)
+    index = hcl.VariableIndex()
+    file_refs = []
+    for filename in filenames:
+        with open(filename, "r", encoding="utf_8",
+                  errors="replace") as file_handle:
+            text = file_handle.read()
+        index.add(text, filename)
+        file_refs.append(scan(text, "module"))
+    return ModuleInfo(
+        fingerprint or _fingerprint(filenames),
+        list(index.declarations),
+        [name for name, declaration in index.declarations.items()
+         if "default" not in declaration.attributes],
+        [[call.name, call.source, list(call.arguments)]
+         for call in index.modules.values()],
+        module_providers(file_refs))
+
+
+def module_providers(file_refs):
+    """Return the providers in "module" scans' refs, in first-seen order.
+
+    Built-in providers, like terraform's, are left out.
+    """
+    return [provider for provider in merge_refs(file_refs, "provider")
+            if provider not in BUILTIN_PROVIDERS]
+
+
+def template_path(module_dir, path):
+    """Return the file a module's templatefile() path refers to, or None.
+
+    Paths may start with ${path.module}; None is returned for paths with
+    any other interpolation, which only Terraform can resolve.
+    """
+    prefix = "${path.module}"
+    if path.startswith(prefix):
+        path = path[len(prefix):].lstrip("/")
+    if "${" in path:
+        return None
+    return os.path.normpath(os.path.join(module_dir, path))
+
+
+def module_artifacts(module_dirs, order=None, natural=False, jobs=None,
+                     cache=None, modname=None):
+    """Return the files generated for each module, from one scan of it.
+
+    The .tf files of all the modules, but for generated stubs and numbered
+    outputs, are scanned together, once, for var uses, declarations,
+    providers and templatefile() paths, and the templates found are then
+    scanned once for template vars. Returns an OrderedDict of module
+    directory to an OrderedDict of file name to content: variables.tf,
+    modstub.tf (for inputs both declared and used), .env, terraform.tfvars
+    and, for modules that render templates, template_vars.tf. modname
+    defaults to the name of each module's directory.
+    """
+    module_files = collections.OrderedDict(
+        (module_dir, _module_files(module_dir)) for module_dir in module_dirs)
+    all_files = list(itertools.chain.from_iterable(module_files.values()))
+    file_refs = dict(zip(
+        all_files, scan_files(all_files, "module", jobs, cache)))
+
+    templates = collections.OrderedDict()
+    for module_dir, filenames in module_files.items():
+        templates[module_dir] = []
+        for path in merge_refs(
+                [file_refs[filename] for filename in filenames],
+                "templatefile"):
+            template = template_path(module_dir, path)
+            if template and os.path.isfile(template):
+                templates[module_dir].append(template)
+            else:
+                logger.warning("module %s template not found: %s",
+                               module_dir, path)
+    all_templates = list(dict.fromkeys(
+        itertools.chain.from_iterable(templates.values())))
+    template_refs = dict(zip(
+        all_templates, scan_files(all_templates, "template", jobs, cache)))
+
+    results = collections.OrderedDict()
+    for module_dir, filenames in module_files.items():
+        refs = [file_refs[filename] for filename in filenames]
+        used = _sorted(merge_refs(refs, "var"), order, natural)
+        inputs = _sorted(
+            list(dict.fromkeys(merge_refs(refs, "variable") + used)),
+            order, natural)
+        artifacts = results[module_dir] = collections.OrderedDict([
+            ("variables.tf", render_variables(used)),
+            ("modstub.tf", render_modstub(
+                inputs,
+                modname or os.path.basename(os.path.abspath(module_dir)),
+                providers=module_providers(refs) or DEFAULT_PROVIDERS)),
+            (".env", render_env(used)),
+            ("terraform.tfvars", render_tfvars(used))])
+        if templates[module_dir]:
+            artifacts["template_vars.tf"] = render_template_vars(_sorted(
+                merge_refs([template_refs[template]
+                            for template in templates[module_dir]],
+                           "template"), order, natural))
+    return results
+
+
+def local_source(module_dir, source):
+    """Return the directory a local module source refers to, or None."""
+    if source and source.startswith(("./", "../")):
+        return os.path.normpath(os.path.join(module_dir, source))
+    return None
+
+
+def module_graph(roots, known=None):
+    """Return the local modules called from roots, transitively.
+
+    Returns an OrderedDict of module directory to ModuleInfo, roots first
+    and then their callees, breadth-first. Only local ("./" or "../")
+    sources are followed. known maps absolute directories to ModuleInfo
+    from an earlier run; a module whose .tf files have the same names,
+    sizes and mtimes is taken from it without being read.
+    """
+    known = known or {}
+    graph = collections.OrderedDict()
+    queue = collections.deque(os.path.normpath(root) for root in roots)
+    while queue:
+        module_dir = queue.popleft()
+        if module_dir in graph:
+            continue
+        fingerprint = _fingerprint(_module_files(module_dir))
+        info = known.get(os.path.abspath(module_dir))
+        if info is None or info.fingerprint != fingerprint:
+            info = read_module(module_dir, fingerprint)
+        graph[module_dir] = info
+        for name, source, _ in info.calls:
+            callee = local_source(module_dir, source)
+            if callee is None:
+                continue
+            if os.path.isdir(callee):
+                queue.append(callee)
+            else:
+                logger.warning("module %s source not found: %s", name, callee)
+    return graph
+
+
+@_timed("render")
+def render_report_json(results):
+    """Return a JSON report of check_modules() results."""
+    import json
+    return json.dumps({
+        "modules": [
+            {"module": module_dir,
+             "missing": result.missing,
+             "unused": result.unused}
+            for module_dir, result in results.items()],
+        "problems": sum(
+            1 for result in results.values()
+            if result.missing or result.unused),
+    }, indent=2) + "\n"
+
+
+@_timed("render")
+def render_report_junit(results):
+    """Return a JUnit XML report of check_modules() results."""
+    from xml.etree import ElementTree
+    failed = [result for result in results.values()
+              if result.missing or result.unused]
+    suite = ElementTree.Element("testsuite", {
+        "name": "scratchrelaxtv",
+        "tests": str(len(results)),
+        "failures": str(len(failed)),
+        "errors": "0"})
+    for module_dir, result in results.items():
+        case = ElementTree.SubElement(suite, "testcase", {
+            "classname": "scratchrelaxtv.check", "name": module_dir})
+        if result.missing or result.unused:
+            failure = ElementTree.SubElement(case, "failure", {
+                "message": "{} missing, {} unused variables".format(
+                    len(result.missing), len(result.unused))})
+            failure.text = "".join([
+                "missing: {}\n".format(" ".join(result.missing)),
+                "unused: {}\n".format(" ".join(result.unused))])
+    return ElementTree.tostring(suite, encoding="unicode") + "\n"
+
+
+@_timed("render")
+def render_variables(tf_vars, types=None):
+    """Return a variables.tf declaring tf_vars.
+
+    types maps names to the (type, default) to declare them with, e.g. from
+    merge_types(); other vars are declared as strings.
+    """
+    types = types or {}
+    return "".join(
+        'variable "{}" {{\n'
+        '  description = ""\n'
+        '  type        = {}\n'
+        '  default     = {}\n'
+        '}}\n\n'.format(remove_prefix(tf_var, "var."), *types.get(
+            tf_var, TYPE_DECLARATIONS["string"])) for tf_var in tf_vars)
+
+
+@_timed("render")
+def render_missing_variables(tf_vars, types=None):
+    """Return declarations of tf_vars to append to a variables.tf."""
+    types = types or {}
+    return "".join(
+        '\nvariable "{}" {{\n'
+        '  description = ""\n'
+        '  type        = {}\n'
+        '  default     = {}\n'
+        '}}\n'.format(tf_var, *types.get(
+            tf_var, TYPE_DECLARATIONS["string"])) for tf_var in tf_vars)
+
+
+@_timed("render")
+def render_modstub(tf_vars, modname, source=None,
+                   providers=DEFAULT_PROVIDERS):
+    """Return a module-use stub for a module named modname.
+
+    source defaults to a sibling directory named modname. The stub passes
+    the module providers, if there are any.
+    """
+    return "".join([
+        'module "{0}" {{\n  source = "{1}"\n\n'.format(
+            modname, source or "../" + modname),
+        "".join([
+            '  providers = {\n',
+            "".join('    {0} = "{0}"\n'.format(provider)
+                    for provider in providers),
+            '  }\n\n']) if providers else "",
+        "".join('  {0} = "${{local.{0}}}"\n'.format(tf_var)
+                for tf_var in tf_vars),
+        '}\n\n'])
+
+
+@_timed("render")
+def render_env(tf_vars):
+    """Return a .env file exporting tf_vars as TF_VAR_s."""
+    return 'unset "${!TF_VAR_@}"\n' + "".join(
+        'export TF_VAR_{}=replace\n'.format(tf_var) for tf_var in tf_vars)
+
+
+@_timed("render")
+def render_tfvars(tf_vars):
+    """Return a .tfvars file setting tf_vars."""
+    return "".join('{} = "replace"\n'.format(tf_var) for tf_var in tf_vars)
+
+
+@_timed("render")
+def render_template_vars(tf_vars):
+    """Return HCL locals with an entry for each template var."""
+    return "".join([
+        'locals {\n  templates_vars = {\n',
+        "".join('    {} = "replace"\n'.format(tf_var) for tf_var in tf_vars),
+        '  }\n}\n'])
+
+
+@_timed("render")
+def update_variables(text, add, remove=(), types=None, prune=None,
+                     keep=None):
+    """Return text, a variables.tf, updated in place.
+
+    The declarations in text are kept byte for byte. Those of the names in
+    add that text does not declare are appended, with types as in
+    render_variables(), using text's line endings. With prune "drop", the
+    declarations of the names in remove, and if keep is given of the names
+    not in keep, are deleted, along with a blank line after each; with
+    prune "comment", they are commented out.
+
+    >>> update_variables('variable "a" {}\\n\\nvariable "b" {}\\n',
+    ...                  ["a", "c"], ["b"], prune="comment")
+    'variable "a" {}\\n\\n# variable "b" {}\\n\\nvariable "c" {...'
+    >>> update_variables('variable "a" {}\\n\\nvariable "b" {}\\n',
+    ...                  ["b"], prune="drop", keep={"b"})
+    'variable "b" {}\\n'
+    """
+    from scratchrelaxtv import hcl
+    blocks = hcl.variable_blocks(text)
+    declared = {name for name, _, _ in blocks}
+    remove = set(remove) if prune else set()
+    if prune and keep is not None:
+        remove.update(name for name in declared if name not in keep)
+
+    parts = []
+    position = 0
+    for name, start, end in blocks:
+        if name not in remove:
+            continue
+        parts.append(text[position:start])
+        if prune == "comment":
+            parts.append("".join(
+                "# " + line if line.strip() else line
+                for line in text[start:end].splitlines(True)))
+        elif text.startswith("\n", end) or text.startswith("\r\n", end):
+            end = text.index("\n", end) + 1
+        position = end
+    parts.append(text[position:])
+    updated = "".join(parts)
+
+    new = [name for name in dict.fromkeys(add) if name not in declared]
+    if new:
+        if updated and not updated.endswith("\n"):
+            updated += "\n"
+        addition = render_missing_variables(new, types)
+        if not updated:
+            addition = addition[1:]
+        if "\r\n" in text:
+            addition = addition.replace("\n", "\r\n")
+        updated += addition
+    return updated
+
+
+@_timed("write")
+def write_output(filename, content, append=False, raw=False):
+    """Write content to filename in one write, atomically.
+
+    The content goes to a temporary file in the same directory which is
+    then renamed over filename, so readers never see a partial file. If
+    filename already holds exactly these bytes, it is left alone, keeping
+    its mtime (and any caches keyed on it) intact. With append, content is
+    added to the end of the existing file. With raw, newlines are written
+    as they are rather than as os.linesep. filename "-" means stdout.
+    Returns whether it wrote.
+    """
+    if filename == "-":
+        sys.stdout.write(content)
+        sys.stdout.flush()
+        return True
+    if not raw:
+        content = content.replace("\n", os.linesep)
+    data = content.encode("utf_8", "surrogateescape")
+    try:
+        with open(filename, "rb") as file_handle:
+            existing = file_handle.read()
+        mode = os.stat(filename).st_mode & 0o7777
+    except FileNotFoundError:
+        existing = mode = None
+
+    if append and existing:
+        data = existing + data
+    if data == existing:
+        logger.info("output file unchanged: %s", filename)
+        return False
+
+    temporary, file_handle = _open_temporary(filename)
+    try:
+        with file_handle:
+            file_handle.write(data)
+        if mode is not None:
+            os.chmod(temporary, mode)
+        os.replace(temporary, filename)
+    except OSError:
+        os.remove(temporary)
+        raise
+    return True
+
+
+def _open_temporary(filename):
+    """Create a file for filename's new content; return its name and file.
+
+    The file is created next to filename, like tempfile's, but with the
+    mode open() gives new files (0o666 less the umask, which the kernel
+    applies, so that threads need not read the process-wide umask).
+    """
+    prefix = os.path.join(os.path.dirname(os.path.abspath(filename)),
+                          ".{}.".format(os.path.basename(filename)))
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    while True:
+        temporary = prefix + os.urandom(6).hex()
+        try:
+            return temporary, os.fdopen(os.open(temporary, flags, 0o666), "wb")
+        except FileExistsError:
+            continue
+
+
+def find_generations(directory, filename, file_extension):
+    """Return the numbered copies of a file, e.g. variables.N.tf, by N.
+
+    A single scan of the directory finds them all, however many there are.
+    """
+    pattern = re.compile(r'^{}\.(\d+){}$'.format(
+        re.escape(filename), re.escape(file_extension)))
+    generations = {}
+    for entry in os.scandir(directory or os.curdir):
+        match = pattern.match(entry.name)
+        if match:
+            generations[int(match.group(1))] = entry.path
+    return generations
+
+
+def next_output(output, force=False, keep=None):
+    """Return the path to write output to.
+
+    That is output itself if forcing or if it does not exist yet, and
+    otherwise the next numbered copy, e.g. variables.3.tf. With keep, the
+    oldest numbered copies are removed to leave keep, counting the new one.
+    """
+    if force or not os.path.isfile(output):
+        return output
+    directory, filename = os.path.split(output)
+    filename, file_extension = os.path.splitext(filename)
+    search = NUMBERED_REGEX.search(filename)
+    if search:
+        filename = search.group(1)
+
+    generations = find_generations(directory, filename, file_extension)
+    index = max(generations, default=0) + 1
+
+    if keep:
+        # make room for the new generation within the limit
+        for old_index in sorted(generations)[:1 - keep or None]:
+            os.remove(generations[old_index])
+            logger.info("removed old file: %s", generations[old_index])
+
+    return os.path.join(directory, ''.join([
+        filename, '.', str(index), file_extension]))
+
+
+def default_output(args, filename):
+    """Return the default output path, inside a lone input directory."""
+    if args.input_dirs and len(args.input_dirs) == 1:
+        return os.path.join(args.input_dirs[0], filename)
+    return filename
 
 
 class BassExtractor():
@@ -53,17 +1609,26 @@ class BassExtractor():
     # valid var names:
     # "A name must start with a letter and may contain only letters,
     # digits, underscores, and dashes."
+    # deprecated: vars are found by the SCANNERS; kept for find_vars()
     var_regex = r'\bvar\.([a-zA-Z][a-zA-Z0-9_-]*)\b'
     variable_regex = r'\bvariable "([^"]+)"'
+    input_pattern = "*.tf"
+    kind = "var"
 
     def __init__(self, args):
         self.args = args
         self.tf_vars = []
+        self.types = {}
+        self.cache = None if args.no_cache else VarCache(args.cache_dir)
         self.log_arguments()
 
     def log_arguments(self):
         """Log the attributes of this run."""
-        logger.info("input file: %s", self.args.input)
+        if self.args.input_dirs:
+            logger.info("input directories: %s",
+                        ", ".join(self.args.input_dirs))
+        else:
+            logger.info("input file: %s", self.args.input)
         logger.info("output file: %s", self.args.output)
 
         if self.args.force:
@@ -78,50 +1643,204 @@ class BassExtractor():
         else:
             logger.info("not ordering output file")
 
+    def update_output(self, add, remove=(), keep=None):
+        """Merge add into the existing output file, pruning remove.
+
+        See update_variables(); the file is rewritten atomically, with its
+        line endings and any bytes that are not UTF-8 kept as they are.
+        """
+        text = ""
+        if os.path.isfile(self.args.output):
+            with open(self.args.output, "rb") as file_handle:
+                text = file_handle.read().decode("utf_8", "surrogateescape")
+        if write_output(self.args.output, update_variables(
+                text, add, remove, self.types, self.args.prune, keep),
+                raw=True):
+            logger.info("updated %s", self.args.output)
+
     def _find_non_existing_filename(self):
-        index = 1
-        while True:
-            if self.args.force or not os.path.isfile(self.args.output):
-                return
-            filename, file_extension = os.path.splitext(self.args.output)
-            pattern = re.compile(r'(.*)\.(\d+)')
-            search = pattern.search(filename)
-            if search:
-                filename = search.group(1)
-                index = int(search.group(2)) + 1
-            self.args.output = ''.join([
-                filename, '.', str(index), file_extension])
-            index += 1
+        self.args.output = next_output(
+            self.args.output, self.args.force, self.args.keep)
 
     @staticmethod
     def get_file_contents(filename):
-        """Return contents of file as a string."""
+        """Return contents of file (or, for "-", stdin) as a string.
+
+        Files are read as UTF-8, whatever the locale, with undecodable
+        bytes replaced.
+        """
+        if filename == "-":
+            return sys.stdin.read()
         entire_file = ""
-        with open(filename, "r") as file_handle:
+        with open(filename, "r", encoding="utf_8",
+                  errors="replace") as file_handle:
             entire_file = file_handle.read()
         return entire_file
 
     @staticmethod
     def find_vars(haystack, regex):
-        """Extract vars from .tf file."""
+        """Extract vars from .tf file.
+
+        Deprecated: use scan() or extract_vars(), which skip comments and
+        find every kind of reference in one pass.
+        """
+        import warnings
+        warnings.warn("find_vars() is deprecated; use scan() or "
+                      "extract_vars()", DeprecationWarning, stacklevel=2)
+        return list(dict.fromkeys(compiled(regex).findall(haystack)))
+
+    def input_files(self):
+        """Return the files to extract vars from."""
+        if self.args.files0_from:
+            return read_file_list(self.args.files0_from)
+        if self.args.input_dirs:
+            return find_input_files(self.args.input_dirs, self.input_pattern)
+        return [self.args.input]
+
+    def syntax(self, kind="var"):
+        """Return the syntax to scan for a kind of reference with."""
+        return _syntax_for(kind, self.args.parser, self.args.infer)
+
+    def scan_files(self, filenames, syntax="hcl"):
+        """Scan files, through the cache unless disabled; "-" is stdin."""
+        paths = [filename for filename in filenames if filename != "-"]
+        file_refs = scan_files(paths, syntax, self.args.jobs, self.cache)
+        if self.cache:
+            self.cache.save()
+        if len(paths) < len(filenames):
+            file_refs.insert(filenames.index("-"),
+                             scan(self.get_file_contents("-"), syntax))
+        return file_refs
+
+    def streaming(self):
+        """Return whether vars can be output as they are read from stdin.
+
+        That is when reading stdin and writing stdout, unsorted and with
+        the regex scanner without --infer, which need no more than a line
+        of input (or a /* comment) at a time.
+        """
+        return self.input_files() == ["-"] and self.args.output == "-"\
+            and not self.sort_order() and self.syntax(self.kind) in (
+                "hcl", "template")
+
+    def extract_stream(self, render):
+        """Write render(vars) to stdout as the vars are read from stdin.
+
+        render must render each var by itself, after a fixed head (that
+        is, render(a + b) == render(a) + render(b)[len(render([])):]).
+        """
+        head = render([])
+        sys.stdout.write(head)
+        self.tf_vars = []
+        seen = set()
+        chunks = read_chunks(sys.stdin)
+        for refs in scan_stream(chunks, self.syntax(self.kind)):
+            new = [name for name in refs[self.kind] if name not in seen]
+            if new:
+                seen.update(new)
+                self.tf_vars.extend(new)
+                sys.stdout.write(render(new)[len(head):])
+                sys.stdout.flush()
+        sys.stdout.flush()
+        return EXIT_OKAY
 
-        var_pattern = re.compile(regex)
-        tf_vars = var_pattern.findall(haystack)
-        tf_vars = list(dict.fromkeys(tf_vars))
+    def watched_files(self):
+        """Return the files whose changes affect the output."""
+        return self.input_files()
+
+    def load_state(self, filename, version):
+        """Return the per-module state saved in the cache directory."""
+        import json
+        if self.args.no_cache:
+            return {}
+        path = os.path.join(
+            self.args.cache_dir or default_cache_dir(), filename)
+        try:
+            with open(path, "r", encoding="utf_8") as file_handle:
+                state = json.load(file_handle)
+        except (OSError, ValueError):
+            return {}
+        if state.get("version") != version:
+            return {}
+        return state.get("modules", {})
+
+    def save_state(self, filename, version, modules):
+        """Save per-module state in the cache directory."""
+        import json
+        if self.args.no_cache:
+            return
+        cache_dir = self.args.cache_dir or default_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        write_output(os.path.join(cache_dir, filename), json.dumps(
+            {"version": version, "modules": modules}))
+
+    def changed_module_dirs(self):
+        """Return the module dirs with files git reports as changed.
+
+        Returns None, after logging why, if git cannot be run or fails.
+        """
+        try:
+            return changed_module_dirs(
+                self.args.input_dirs or [os.curdir], self.args.since,
+                self.args.staged)
+        except OSError as err:
+            logger.error("could not ask git for changed files: %s", err)
+            return None
+
+    def sort_order(self):
+        """Return the order vars were asked for: "asc", "desc" or None."""
+        return "asc" if self.args.asc else "desc" if self.args.desc else None
+
+    def sort_vars(self, tf_vars):
+        """Sort vars in place as requested, and return them."""
+        return _sorted(tf_vars, self.sort_order(), self.args.natural)
+
+    def extract_modules(self, render, infer=False, update=False):
+        """Write render(vars) into every module under the input dirs.
+
+        Modules are read and written concurrently, up to --jobs at a time,
+        on the asynchronous pipeline. The output file name is that of the
+        output file. With infer, render also takes the inferred types; with
+        update, existing variables files are merged into as by
+        update_output(). Returns EXIT_NOT_OKAY if a module could not be read
+        or written; the others are still done.
+        """
+        from scratchrelaxtv import pipeline
+        module_dirs = find_module_dirs(
+            self.args.input_dirs or [os.curdir], jobs=self.args.jobs)
+        logger.info("extracting from %d module directories", len(module_dirs))
+        try:
+            pipeline.run(pipeline.extract_modules(
+                module_dirs, self.kind, os.path.basename(self.args.output),
+                render, self.args.parser, self.sort_order(),
+                self.args.natural, self.args.force, self.args.keep,
+                self.args.jobs, self.cache, infer, update, self.args.prune))
+        except OSError:
+            # each module that failed has been logged
+            return EXIT_NOT_OKAY
+        finally:
+            if self.cache:
+                self.cache.save()
+        return EXIT_OKAY
 
-        return tf_vars
+    def find_vars_in_file(self, kind):
+        """Extract vars from .tf file(s)."""
 
-    def find_vars_in_file(self, regex):
-        """Extract vars from .tf file."""
+        file_refs = self.scan_files(self.input_files(), self.syntax(kind))
+        self.types = merge_types(file_refs)
+        self.tf_vars = self.sort_vars(merge_refs(file_refs, kind))
 
-        self.tf_vars = BassExtractor.find_vars(
-            BassExtractor.get_file_contents(self.args.input),
-            regex)
+    def vars_from_refs(self, file_refs):
+        """Return the vars to output, given a dict of each file's refs."""
+        input_refs = [file_refs[filename] for filename in self.input_files()
+                      if filename in file_refs]
+        self.types = merge_types(input_refs)
+        return self.sort_vars(merge_refs(input_refs, self.kind))
 
-        if self.args.asc:
-            self.tf_vars.sort()
-        elif self.args.desc:
-            self.tf_vars.sort(reverse=True)
+    def regenerate(self, tf_vars):
+        """Output vars found by vars_from_refs()."""
+        self.tf_vars = tf_vars
+        self.write_file()
 
 
 class VarExtractor(BassExtractor):
@@ -138,36 +1857,58 @@ class VarExtractor(BassExtractor):
             args.input = "main.tf"
 
         if not args.output:
-            args.output = "variables.tf"
+            args.output = default_output(args, "variables.tf")
 
         super().__init__(args)
 
     def write_file(self):
         """Output vars to .tf file."""
+        if self.args.update and os.path.isfile(self.args.output):
+            return self.update_output(self.tf_vars, keep=set(self.tf_vars))
         self._find_non_existing_filename()
-        with open(self.args.output, "w", encoding='utf_8') as file_handle:
-            for tf_var in self.tf_vars:
-                file_handle.write('variable "')
-                file_handle.write(remove_prefix(tf_var, "var."))
-                file_handle.write('" {\n')
-                file_handle.write('  description = ""\n')
-                file_handle.write('  type        = string\n')
-                file_handle.write('  default     = ""\n')
-                file_handle.write('}\n\n')
+        write_output(
+            self.args.output, render_variables(self.tf_vars, self.types))
 
     def extract(self):
         """Extract vars from .tf file."""
-        self.find_vars_in_file(self.var_regex)
+        if self.args.since or self.args.staged:
+            return self.extract_changed()
+        if self.args.recursive:
+            return self.extract_modules(
+                render_variables, self.args.infer, self.args.update)
+
+        if self.streaming():
+            return self.extract_stream(
+                lambda tf_vars: render_variables(tf_vars, self.types))
+
+        self.find_vars_in_file(self.kind)
         self.write_file()
 
         return EXIT_OKAY
 
+    def extract_changed(self):
+        """Write a variables.tf into each module with changed files."""
+        module_dirs = self.changed_module_dirs()
+        if module_dirs is None:
+            return EXIT_NOT_OKAY
+        logger.info("%d changed module directories", len(module_dirs))
+        for module_dir in module_dirs:
+            self.args.input_dirs = [module_dir]
+            self.args.output = os.path.join(module_dir, "variables.tf")
+            self.find_vars_in_file(self.kind)
+            self.write_file()
+
+        return EXIT_OKAY
+
 
 class StubMaker(BassExtractor):
     """
     A class that extracts variables from Terraform HCL files and generates a
     module-use stub.
     """
+
+    kind = "variable"
+
     def __init__(self, args):
         """Instantiate"""
         logger.info("generating module usage stub")
@@ -177,39 +1918,136 @@ class StubMaker(BassExtractor):
             args.input = "variables.tf"
 
         if not args.output:
-            args.output = "modstub.tf"
+            args.output = default_output(args, "modstub.tf")
 
         if not args.modname:
-            args.modname = os.path.basename(os.getcwd())
+            args.modname = os.path.basename(os.path.abspath(
+                args.input_dirs[0] if args.input_dirs else os.getcwd()))
 
+        self.providers = []
         super().__init__(args)
 
+    def syntax(self, kind="variable"):
+        """Return the syntax to scan for a kind of reference with."""
+        # the regex scan that finds the declarations also finds providers
+        if self.args.parser == "regex":
+            return "module"
+        return super().syntax(kind)
+
+    def find_vars_in_file(self, kind):
+        """Extract vars, and the providers they are for, from .tf file(s)."""
+        file_refs = self.scan_files(self.input_files(), self.syntax(kind))
+        self.tf_vars = self.sort_vars(merge_refs(file_refs, kind))
+        if self.syntax(kind) == "module":
+            self.providers = module_providers(file_refs)
+
+    def vars_from_refs(self, file_refs):
+        """Return the vars, and the providers they are for, to output."""
+        tf_vars = super().vars_from_refs(file_refs)
+        providers = []
+        if self.syntax(self.kind) == "module":
+            providers = module_providers(
+                [file_refs[filename] for filename in self.input_files()
+                 if filename in file_refs])
+        return tf_vars, providers
+
+    def regenerate(self, tf_vars):
+        """Output the vars and providers found by vars_from_refs()."""
+        self.tf_vars, self.providers = tf_vars
+        self.write_file()
+
     def write_file(self):
         """Output vars to .tf file."""
         self._find_non_existing_filename()
-        with open(self.args.output, "w", encoding='utf_8') as file_handle:
-            file_handle.write('module ')
-            file_handle.write("".join(['"', self.args.modname, '"']))
-            file_handle.write(" {\n")
-            file_handle.write('  source = ')
-            file_handle.write("".join(['"', "../", self.args.modname, '"']))
-            file_handle.write("\n\n")
-            file_handle.write("  providers = {\n    aws = \"aws\"\n  }\n\n")
-            for tf_var in self.tf_vars:
-                file_handle.write("".join([
-                    '  ',
-                    tf_var,
-                    " = \"${local.",
-                    tf_var, "}\"\n"]))
-            file_handle.write('}\n\n')
+        write_output(self.args.output, render_modstub(
+            self.tf_vars, self.args.modname,
+            providers=self.providers or DEFAULT_PROVIDERS))
 
     def extract(self):
         """Extract vars from .tf file."""
-        self.find_vars_in_file(self.variable_regex)
+        if self.args.recursive:
+            return self.stub_modules()
+
+        self.find_vars_in_file(self.kind)
         self.write_file()
 
         return EXIT_OKAY
 
+    def stub_modules(self):
+        """Write a stub into every local module called from the input dirs.
+
+        Each stub uses the name and source of the first call to the module.
+        Only modules whose inputs, or whose callers' arguments, changed since
+        the last run are regenerated and validated. Returns EXIT_NOT_OKAY if
+        a call leaves out a required input or passes an undeclared one.
+        """
+        import hashlib
+        import json
+        previous = self.load_state("stubs.json", STUB_STATE_VERSION)
+        graph = module_graph(
+            self.args.input_dirs or [os.curdir],
+            {module_dir: ModuleInfo(*entry["info"])
+             for module_dir, entry in previous.items()})
+
+        callers = collections.OrderedDict()
+        for caller, info in graph.items():
+            for name, source, arguments in info.calls:
+                callee = local_source(caller, source)
+                if callee in graph:
+                    callers.setdefault(callee, []).append(
+                        (caller, name, source, arguments))
+
+        state = {}
+        regenerated = 0
+        invalid = False
+        for module_dir, info in graph.items():
+            key = os.path.abspath(module_dir)
+            state[key] = {"info": list(info)}
+            calls = callers.get(module_dir)
+            if not calls:
+                continue
+
+            _, name, source, _ = calls[0]
+            content = render_modstub(
+                self.sort_vars(list(info.inputs)), name, source,
+                info.providers or DEFAULT_PROVIDERS)
+            digest = hashlib.sha1(json.dumps(
+                [content, [call[3] for call in calls]]).encode(
+                    "utf_8")).hexdigest()
+            stub = os.path.join(module_dir, "modstub.tf")
+            if previous.get(key, {}).get("stub") == digest\
+                    and os.path.exists(stub):
+                state[key]["stub"] = digest
+                continue
+
+            valid = True
+            for caller, call_name, _, arguments in calls:
+                missing = [input_name for input_name in info.required
+                           if input_name not in arguments]
+                undeclared = [argument for argument in arguments
+                              if argument not in info.inputs]
+                if missing:
+                    logger.warning(
+                        "module %s in %s is missing required inputs: %s",
+                        call_name, caller, ", ".join(missing))
+                if undeclared:
+                    logger.warning(
+                        "module %s in %s passes undeclared inputs: %s",
+                        call_name, caller, ", ".join(undeclared))
+                valid = valid and not missing and not undeclared
+
+            if write_output(stub, content):
+                regenerated += 1
+            # invalid modules are validated again on the next run
+            if valid:
+                state[key]["stub"] = digest
+            invalid = invalid or not valid
+
+        logger.info("regenerated %d of %d module stubs",
+                    regenerated, len(callers))
+        self.save_state("stubs.json", STUB_STATE_VERSION, state)
+        return EXIT_NOT_OKAY if invalid else EXIT_OKAY
+
 
 class EnvGenerator(BassExtractor):
     """
@@ -228,30 +2066,20 @@ class EnvGenerator(BassExtractor):
             args.input = "main.tf"
 
         if not args.output and args.env:
-            args.output = ".env"
+            args.output = default_output(args, ".env")
 
         if not args.output and args.tfvars:
-            args.output = "terraform.tfvars"
+            args.output = default_output(args, "terraform.tfvars")
 
         super().__init__(args)
 
     def _write_env(self):
         """Output vars to .env file."""
-        with open(self.args.output, "w", encoding='utf_8') as file_handle:
-            file_handle.write('unset "${!TF_VAR_@}"\n')
-            for tf_var in self.tf_vars:
-                file_handle.write("".join([
-                    'export TF_VAR_',
-                    tf_var,
-                    "=replace\n"]))
+        write_output(self.args.output, render_env(self.tf_vars))
 
     def _write_tfvars(self):
         """Output vars to .tfvars file."""
-        with open(self.args.output, "w", encoding='utf_8') as file_handle:
-            for tf_var in self.tf_vars:
-                file_handle.write("".join([
-                    tf_var,
-                    ' = "replace"\n']))
+        write_output(self.args.output, render_tfvars(self.tf_vars))
 
     def write_file(self):
         """Output vars to file."""
@@ -263,7 +2091,14 @@ class EnvGenerator(BassExtractor):
 
     def extract(self):
         """Extract vars from .tf file."""
-        self.find_vars_in_file(self.var_regex)
+        if self.args.recursive:
+            return self.extract_modules(
+                render_env if self.args.env else render_tfvars)
+        if self.streaming():
+            return self.extract_stream(
+                render_env if self.args.env else render_tfvars)
+
+        self.find_vars_in_file(self.kind)
         self.write_file()
 
         return EXIT_OKAY
@@ -282,49 +2117,114 @@ class Checker(BassExtractor):
             args.input = "main.tf"
 
         if not args.output:
-            args.output = "variables.tf"
+            args.output = default_output(args, "variables.tf")
 
+        self.index = None
         super().__init__(args)
 
     def write_file(self):
         """Output vars to .tf file."""
-        with open(self.args.output, "a+", encoding='utf_8') as file_handle:
-            for tf_var in self.tf_vars:
-                file_handle.write('\n')
-                file_handle.write('variable "')
-                file_handle.write(tf_var)
-                file_handle.write('" {\n')
-                file_handle.write('  description = ""\n')
-                file_handle.write('  type        = string\n')
-                file_handle.write('  default     = ""\n')
-                file_handle.write('}\n')
+        write_output(
+            self.args.output,
+            render_missing_variables(self.tf_vars, self.types),
+            append=True)
+
+    def var_files(self, input_files):
+        """Return the files variables may be declared in."""
+        # in directory (or file list) mode, variables may be declared in
+        # any .tf file
+        if not self.args.input_dirs and not self.args.files0_from:
+            return [self.args.output]
+        var_files = list(input_files)
+        if os.path.isfile(self.args.output):
+            var_files.append(self.args.output)
+        return list(dict.fromkeys(var_files))
+
+    def watched_files(self):
+        """Return the files whose changes affect the output."""
+        input_files = self.input_files()
+        return list(dict.fromkeys(input_files + self.var_files(input_files)))
 
     def find_missing(self):
         """Find missing vars in .tf files."""
-        main_vars = self.find_vars(
-            self.get_file_contents(self.args.input),
-            self.var_regex)
-
-        var_vars = self.find_vars(
-            self.get_file_contents(self.args.output),
-            self.variable_regex)
+        input_files = self.input_files()
+        var_files = self.var_files(input_files)
+
+        if self.args.parser == "hcl":
+            return self._find_missing_indexed(input_files, var_files)
+
+        # each file is read and scanned once, whichever list(s) it is in
+        all_files = list(dict.fromkeys(input_files + var_files))
+        return self.vars_from_refs(
+            dict(zip(all_files, self.scan_files(all_files, self.syntax()))))
+
+    def vars_from_refs(self, file_refs):
+        """Return missing and unused vars, given a dict of each file's refs."""
+        from scratchrelaxtv import names
+        input_files = self.input_files()
+        input_refs = [file_refs[filename] for filename in input_files
+                      if filename in file_refs]
+        self.types = merge_types(input_refs)
+        table = names.NameTable()
+        missing, unused = table.compare(
+            [table.postings(refs["var"], ()) for refs in input_refs]
+            + [table.postings((), file_refs[filename]["variable"])
+               for filename in self.var_files(input_files)
+               if filename in file_refs])
+
+        return {'main': missing, 'var': unused}
+
+    def regenerate(self, tf_vars):
+        """Report (and with force, add) the vars found by vars_from_refs()."""
+        self.report(tf_vars)
+
+    def _find_missing_indexed(self, input_files, var_files):
+        """Find missing vars using an index built by the HCL2 lexer."""
+        from scratchrelaxtv import hcl
+        self.index = hcl.VariableIndex()
+        for filename in var_files:
+            self.index.add(self.get_file_contents(filename), filename)
+
+        # in directory mode, the input files are among the var files
+        usage = self.index
+        if not set(input_files) <= set(var_files):
+            usage = hcl.VariableIndex()
+            for filename in input_files:
+                usage.add(self.get_file_contents(filename), filename)
 
         return {
-            'main': list(set(main_vars) - set(var_vars)),
-            'var': list(set(var_vars) - set(main_vars))
+            'main': [name for name in usage.usages
+                     if name not in self.index.declarations],
+            'var': [name for name in self.index.declarations
+                    if name not in usage.usages]
         }
 
-    def extract(self):
-        """Check for missing vars in .tf files."""
-        missing = self.find_missing()
-
+    def log_incomplete(self):
+        """Warn about declarations missing a type or description."""
+        for declaration in self.index.declarations.values():
+            absent = [attribute for attribute in ("type", "description")
+                      if attribute not in declaration.attributes]
+            if absent:
+                logger.warning(
+                    "%s:%s: variable %s has no %s",
+                    declaration.location.filename,
+                    declaration.location.line,
+                    declaration.name,
+                    " or ".join(absent))
+
+    def report(self, missing):
+        """Log missing and unused vars, adding missing ones if forced.
+
+        With --update, missing vars are added to the variables file and,
+        with --prune, unused ones dropped or commented out, in place.
+        """
         if missing['main']:
             logger.warning(
                 "input file %s is missing variables:\n%s",
                 self.args.input,
                 '\n'.join(missing['main'])
             )
-            if self.args.force:
+            if self.args.force and not self.args.update:
                 self.tf_vars = missing['main']
                 self.write_file()
         if missing['var']:
@@ -333,6 +2233,94 @@ class Checker(BassExtractor):
                 self.args.output,
                 '\n'.join(missing['var'])
             )
+        if self.args.update and (missing['main'] or missing['var']):
+            self.update_output(missing['main'], missing['var'])
+
+    def check_modules(self):
+        """Check every module directory under the input directories.
+
+        With --since or --staged, only the modules with files git reports
+        as changed are checked, and the report takes the results of the
+        others from earlier runs. Returns EXIT_NOT_OKAY if any module
+        checked has missing or unused vars.
+        """
+        changed_only = self.args.since or self.args.staged
+        if changed_only:
+            module_dirs = self.changed_module_dirs()
+            if module_dirs is None:
+                return EXIT_NOT_OKAY
+            logger.info("checking %d changed module directories",
+                        len(module_dirs))
+        else:
+            module_dirs = find_module_dirs(
+                self.args.input_dirs or [os.curdir], jobs=self.args.jobs)
+            logger.info("checking %d module directories", len(module_dirs))
+        results = check_modules(
+            module_dirs, self.syntax(), self.args.jobs, self.cache)
+        if self.cache:
+            self.cache.save()
+        report = self.remember_results(results, not changed_only)
+
+        for module_dir, result in results.items():
+            if result.missing:
+                logger.warning("module %s is missing variables: %s",
+                               module_dir, ", ".join(result.missing))
+                if self.args.force:
+                    write_output(
+                        os.path.join(module_dir, "variables.tf"),
+                        render_missing_variables(result.missing),
+                        append=True)
+            if result.unused:
+                logger.warning("module %s has unused variables: %s",
+                               module_dir, ", ".join(result.unused))
+
+        if self.args.report:
+            render = render_report_json
+            if self.args.report_format == "junit":
+                render = render_report_junit
+            write_output(self.args.report, render(report))
+
+        if any(result.missing or result.unused
+               for result in results.values()):
+            return EXIT_NOT_OKAY
+        return EXIT_OKAY
+
+    def remember_results(self, results, complete):
+        """Save check_modules() results; return them with remembered ones.
+
+        Remembered results are those of other modules under the input
+        directories that still exist, unless the results are complete (of
+        every module under them), in which case they are forgotten.
+        """
+        remembered = self.load_state("checks.json", CHECK_STATE_VERSION)
+        roots = {os.path.join(os.path.abspath(root), ""): os.path.isabs(root)
+                 for root in self.args.input_dirs or [os.curdir]}
+        report = collections.OrderedDict()
+        for key, result in sorted(remembered.items()):
+            root = next((root for root in roots
+                         if os.path.join(key, "").startswith(root)), None)
+            if root is None:
+                continue
+            remembered.pop(key)
+            if not complete and os.path.isdir(key):
+                # shown like the paths walked from the same root
+                report[key if roots[root] else os.path.relpath(key)] =\
+                    CheckResult(*result)
+        for module_dir, result in results.items():
+            remembered[os.path.abspath(module_dir)] = list(result)
+            report[module_dir] = result
+        self.save_state("checks.json", CHECK_STATE_VERSION, remembered)
+        return collections.OrderedDict(sorted(report.items()))
+
+    def extract(self):
+        """Check for missing vars in .tf files."""
+        if self.args.recursive or self.args.since or self.args.staged:
+            return self.check_modules()
+
+        missing = self.find_missing()
+        if self.index:
+            self.log_incomplete()
+        self.report(missing)
 
         return EXIT_OKAY
 
@@ -343,7 +2331,8 @@ class TemplateExtractor(BassExtractor):
     creates HCL showing all template variables.
     """
 
-    var_regex = r'(?<!\$)\${([a-zA-Z][a-zA-Z0-9_-]+)}'
+    kind = "template"
+    input_pattern = "**/*"
 
     def __init__(self, args):
         """Instantiate"""
@@ -354,29 +2343,91 @@ class TemplateExtractor(BassExtractor):
             args.input = "template.sh"
 
         if not args.output:
-            args.output = "template_vars.tf"
+            args.output = default_output(args, "template_vars.tf")
 
         super().__init__(args)
 
+    def input_files(self):
+        """Return the templates to extract vars from.
+
+        The input may be a file, a directory (meaning every file under it)
+        or a glob, where "**" matches any number of subdirectories.
+        """
+        import glob
+        if self.args.files0_from:
+            return read_file_list(self.args.files0_from)
+        if self.args.input_dirs:
+            filenames = find_input_files(
+                self.args.input_dirs, self.input_pattern)
+        elif os.path.isdir(self.args.input):
+            filenames = find_input_files([self.args.input], self.input_pattern)
+        elif glob.has_magic(self.args.input):
+            filenames = sorted(glob.glob(self.args.input, recursive=True))
+        else:
+            return [self.args.input]
+        # leave out earlier outputs, which may be inside the directory
+        root, extension = os.path.splitext(os.path.basename(self.args.output))
+        output = compiled(r'^{}(\.\d+)?{}$'.format(
+            re.escape(root), re.escape(extension)))
+        return [filename for filename in filenames
+                if os.path.isfile(filename)
+                and not output.match(os.path.basename(filename))]
+
     def write_file(self):
         """Output vars to .tf file."""
         self._find_non_existing_filename()
 
-        with open(self.args.output, "w", encoding='utf_8') as file_handle:
-
-            file_handle.write('locals {\n')
-            file_handle.write('  templates_vars = {\n')
-            for tf_var in self.tf_vars:
-                file_handle.write("".join([
-                    "    ",
-                    tf_var,
-                    " = ",
-                    "\"replace\"\n"]))
-            file_handle.write('  }\n}\n')
+        write_output(
+            self.args.output, render_template_vars(self.tf_vars))
 
     def extract(self):
         """Extract vars from .tf file."""
-        self.find_vars_in_file(self.var_regex)
+        self.find_vars_in_file(self.kind)
+        self.write_file()
+
+        return EXIT_OKAY
+
+
+class ArtifactMaker(BassExtractor):
+    """
+    A class that scans Terraform modules once and generates all their files:
+    variables.tf, modstub.tf, .env, terraform.tfvars and template_vars.tf.
+    """
+
+    def __init__(self, args):
+        """Instantiate"""
+        logger.info("generating all module files")
+
+        # defaults
+        if not args.input_dirs:
+            args.input_dirs = [os.curdir]
+
+        super().__init__(args)
+
+    def module_dirs(self):
+        """Return the module directories to generate files for."""
+        if self.args.recursive:
+            return find_module_dirs(self.args.input_dirs, jobs=self.args.jobs)
+        return list(self.args.input_dirs)
+
+    def write_file(self):
+        """Output each module's files into it."""
+        module_dirs = self.module_dirs()
+        results = module_artifacts(
+            module_dirs, self.sort_order(), self.args.natural,
+            self.args.jobs, self.cache,
+            self.args.modname if len(module_dirs) == 1 else None)
+        if self.cache:
+            self.cache.save()
+        for module_dir, artifacts in results.items():
+            for filename, content in artifacts.items():
+                output = next_output(os.path.join(module_dir, filename),
+                                     self.args.force, self.args.keep)
+                write_output(output, content)
+                logger.info("wrote %s", output)
+
+    def extract(self):
+        """Extract vars from .tf files and write all module files."""
         self.write_file()
 
         return EXIT_OKAY
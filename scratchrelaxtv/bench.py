@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""scratchrelaxtv benchmarks.
+
+Generates a synthetic Terraform corpus of a chosen size and times the hot
+paths of scratchrelaxtv over it: scanning, checking, writing each output
+format and removing files. Results (seconds, throughput and peak traced
+memory per benchmark) can be saved as a JSON baseline and later runs
+compared against it to catch regressions.
+
+Micro-benchmarks (--micro) time the regex hot paths against the
+implementations they replaced, on generated code with a given number of
+var. references.
+
+Example:
+    Record a baseline, then compare a later run with it::
+
+        $ python -m scratchrelaxtv.bench --variables 10000 --files 100 \\
+            --output baseline.json
+        $ python -m scratchrelaxtv.bench --variables 10000 --files 100 \\
+            --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import scratchrelaxtv
+from scratchrelaxtv import cli
+
+
+DEFAULT_TOLERANCE = 0.25
+
+
+def generate_corpus(root, variables=100, files=10, modules=1,
+                    refs_per_var=3, seed=0):
+    """Write a synthetic module tree under root; return the module dirs.
+
+    Each module gets files .tf files that together use its share of the
+    variables refs_per_var times each, in shuffled order, with comments,
+    locals and module outputs mixed in, plus a variables.tf declaring
+    them all.
+    """
+    rand = random.Random(seed)
+    module_dirs = []
+    per_module = max(1, variables // modules)
+    per_file = max(1, files // modules)
+    for module in range(modules):
+        module_dir = os.path.join(root, "module{}".format(module))
+        os.makedirs(module_dir, exist_ok=True)
+        names = ["var_{}_{}".format(module, index)
+                 for index in range(per_module)]
+        uses = names * refs_per_var
+        rand.shuffle(uses)
+        chunk = max(1, -(-len(uses) // per_file))
+        for index in range(per_file):
+            lines = []
+            for use in uses[index * chunk:(index + 1) * chunk]:
+                lines.append('resource "null_resource" "{0}_{1}" {{\n'
+                             '  # var.commented_{0}\n'
+                             '  triggers = {{\n'
+                             '    value = "${{var.{0}}}"\n'
+                             '    other = local.{0}\n'
+                             '    out   = module.m{1}.id\n'
+                             '  }}\n}}\n\n'.format(use, index))
+            with open(os.path.join(module_dir, "main{}.tf".format(index)),
+                      "w", encoding="utf_8") as file_handle:
+                file_handle.write("".join(lines))
+        with open(os.path.join(module_dir, "variables.tf"), "w",
+                  encoding="utf_8") as file_handle:
+            file_handle.write(scratchrelaxtv.render_variables(names))
+        module_dirs.append(module_dir)
+    return module_dirs
+
+
+def measure(function, *args, setup=None):
+    """Run function(*args); return its result, seconds and peak bytes.
+
+    Tracing allocations slows Python code down several times, so the
+    function is run twice: once timed and once traced. setup, if given,
+    is called before each run.
+    """
+    if setup:
+        setup()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def generated_code(references, unique=1000):
+    """Return machine-generated-looking HCL with references var. uses."""
+    return "".join(
+        '  value_{0} = "${{var.input_{1}}}" # from var.input_{1}\n'.format(
+            index, index % unique)
+        for index in range(references))
+
+
+def _unguarded(scanner):
+    # the scanner without its leading first-character lookahead
+    pattern = re.sub(r'^\(\?=\[[^]]*\]\)\(\?:', "", scanner.pattern)
+    return re.compile(pattern[:-1] if pattern != scanner.pattern
+                      else pattern, scanner.flags)
+
+
+def micro(references=1000000, repeat=3):
+    """Time hot paths against their previous versions; return a dict.
+
+    Each entry maps a benchmark to the best of repeat runs, in seconds,
+    of the current and the previous implementation.
+    """
+    text = generated_code(references)
+    guarded = scratchrelaxtv.SCANNERS["hcl"]
+    unguarded = _unguarded(guarded)
+    pairs = {
+        "scan": (
+            lambda: sum(1 for _ in guarded.finditer(text)),
+            lambda: sum(1 for _ in unguarded.finditer(text))),
+    }
+    results = {}
+    for name, (current, previous) in pairs.items():
+        timings = []
+        for function in (current, previous):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                function()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best)
+        results[name] = {"seconds": timings[0], "previous": timings[1]}
+    return results
+
+
+def _args(argv):
+    return cli.parse_args(argv + ["--no-cache"])
+
+
+def _write(extractor_class, argv, tf_vars):
+    extractor = extractor_class(_args(argv))
+    extractor.tf_vars = tf_vars
+    extractor.write_file()
+
+
+def run(variables=100, files=10, modules=1, jobs=1):
+    """Generate a corpus and return the benchmark results as a dict."""
+    results = {}
+
+    def record(name, count, unit, function, *args, setup=None):
+        result, elapsed, peak = measure(function, *args, setup=setup)
+        results[name] = {
+            "seconds": elapsed,
+            "peak_bytes": peak,
+            "throughput": count / elapsed if elapsed else None,
+            "unit": unit,
+        }
+        return result
+
+    with tempfile.TemporaryDirectory() as root:
+        module_dirs = generate_corpus(root, variables, files, modules)
+        filenames = scratchrelaxtv.find_input_files(module_dirs)
+        text = "".join(scratchrelaxtv.BassExtractor.get_file_contents(name)
+                       for name in filenames)
+        size = len(text.encode("utf_8"))
+
+        record("scan", size, "bytes/s", scratchrelaxtv.scan, text)
+        record("scan_files", size, "bytes/s",
+               scratchrelaxtv.scan_files, filenames, "hcl", jobs)
+        record("find_missing", size, "bytes/s",
+               scratchrelaxtv.Checker(_args(
+                   ["-c", "-j", str(jobs)]
+                   + [arg for module_dir in module_dirs
+                      for arg in ("-I", module_dir)])).find_missing)
+        record("check_modules", size, "bytes/s",
+               scratchrelaxtv.check_modules, module_dirs, "hcl", jobs)
+
+        tf_vars = scratchrelaxtv.find_vars_in_files(filenames, jobs=jobs)
+        out = os.path.join(root, "out")
+        os.mkdir(out)
+        for name, extractor_class, argv in (
+                ("write_variables", scratchrelaxtv.VarExtractor, []),
+                ("write_modstub", scratchrelaxtv.StubMaker, ["-m"]),
+                ("write_env", scratchrelaxtv.EnvGenerator, ["-e"]),
+                ("write_tfvars", scratchrelaxtv.EnvGenerator, ["-t"]),
+                ("write_missing", scratchrelaxtv.Checker, ["-c"]),
+                ("write_template_vars", scratchrelaxtv.TemplateExtractor,
+                 ["--template"])):
+            output = os.path.join(out, name)
+            record(name, len(tf_vars), "vars/s", _write, extractor_class,
+                   argv + ["-f", "-o", output], tf_vars)
+
+        def make_removable():
+            for module_dir in module_dirs:
+                for index in range(1, 11):
+                    open(os.path.join(module_dir, "variables.{}.tf".format(
+                        index)), "w").close()
+
+        record("remove_files", 10 * len(module_dirs), "files/s",
+               scratchrelaxtv.remove_files, root, scratchrelaxtv.IGNORE_DIRS,
+               (), False, jobs, setup=make_removable)
+
+    return {
+        "version": scratchrelaxtv.__version__,
+        "python": platform.python_version(),
+        "params": {"variables": variables, "files": files,
+                   "modules": modules, "jobs": jobs, "bytes": size},
+        "results": results,
+    }
+
+
+def compare(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    """Return the benchmarks more than tolerance slower than the baseline.
+
+    Each regression is a (name, baseline seconds, current seconds) tuple.
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before and result["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append((name, before["seconds"], result["seconds"]))
+    return regressions
+
+
+def parse_args(args):
+    """Parse args list."""
+    parser = argparse.ArgumentParser(prog="python -m scratchrelaxtv.bench")
+    parser.add_argument("--variables", type=int, default=1000,
+                        help="number of variables in the corpus")
+    parser.add_argument("--files", type=int, default=10,
+                        help="number of .tf files in the corpus")
+    parser.add_argument("--modules", type=int, default=1,
+                        help="number of modules to spread them across")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="parallel workers for scans and walks")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="save the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the results with a JSON baseline")
+    parser.add_argument("--micro", type=int, metavar="REFERENCES",
+                        help="instead, time regex hot paths against their "
+                        "previous versions on generated code with "
+                        "REFERENCES var. uses")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="fraction slower than baseline that fails")
+    return parser.parse_args(args)
+
+
+def main():
+    """Entry point for the benchmarks."""
+    args = parse_args(sys.argv[1:])
+    if args.micro:
+        for name, result in sorted(micro(args.micro).items()):
+            print("{:<20} {:>10.4f}s (previously {:.4f}s)".format(
+                name, result["seconds"], result["previous"]))
+        sys.exit(scratchrelaxtv.EXIT_OKAY)
+
+    results = run(args.variables, args.files, args.modules, args.jobs)
+
+    for name, result in sorted(results["results"].items()):
+        print("{:<20} {:>10.4f}s {:>14.0f} {:<8} {:>12} peak bytes".format(
+            name, result["seconds"], result["throughput"] or 0,
+            result["unit"], result["peak_bytes"]))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf_8") as file_handle:
+            json.dump(results, file_handle, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf_8") as file_handle:
+            regressions = compare(
+                json.load(file_handle), results, args.tolerance)
+        for name, before, after in regressions:
+            print("REGRESSION {}: {:.4f}s -> {:.4f}s".format(
+                name, before, after))
+        if regressions:
+            sys.exit(scratchrelaxtv.EXIT_NOT_OKAY)
+
+    sys.exit(scratchrelaxtv.EXIT_OKAY)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,24 +10,89 @@ Running scratchrelaxtv without any options reads a main.tf, extracts the vars
 from that file, and generates a variables.tf file with those variables.
 
 Options include:
-    -i, -o  changing input/output file names
+    -i, -o  changing input/output file names (- for stdin/stdout)
+    -I      extract from every .tf file in one or more module directories
+    -j      number of parallel workers for multi-file scans
     -f      force overwriting the output file
+    -u      merge into an existing variables file in place
     -a, -d  sort ascending, descending (omit to preserve original order)
+    -A      generate all of a module's files from one scan of it
+    -w      watch inputs and regenerate when their variables change
+    --stats, --profile  report where the time and memory of a run went
+    --serve keep running, answering JSON-RPC requests with a warm cache
 """
 import argparse
+import contextlib
 import sys
 
 import scratchrelaxtv
+from scratchrelaxtv import watch
 
 
 def parse_args(args):
     """Parse args list."""
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", help="file to extract vars from")
+    parser.add_argument("-i", "--input",
+                        help="file to extract vars from, or - for stdin "
+                        "(with --template, also a directory or a glob like "
+                        "'tpl/**/*.tpl')")
+    parser.add_argument("-I", "--input-dir", action="append",
+                        dest="input_dirs", metavar="DIR",
+                        help="module directory to extract vars from all .tf "
+                        "files in (repeatable)")
+    parser.add_argument("--files0-from", metavar="FILE",
+                        help="extract vars from the files named in FILE (or "
+                        "- for stdin), NUL-delimited as by git ls-files -z")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="number of parallel workers (default: CPUs), "
+                        "or of concurrent module reads and writes with -R")
+    parser.add_argument("--no-cache", default=False, action="store_true",
+                        help="do not read or update the extracted vars cache")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        help="directory for the extracted vars cache")
+    parser.add_argument("--parser", choices=("regex", "hcl"),
+                        default="regex",
+                        help="find vars with fast regexes (default) or the "
+                        "HCL2 lexer, which ignores comments and literals")
+    parser.add_argument("--infer", default=False, action="store_true",
+                        help="declare vars with the type their uses suggest "
+                        "(count: number, for_each: map, [0]: list, .attr: "
+                        "object, ?: bool) instead of string")
+    parser.add_argument("-w", "--watch", default=False, action="store_true",
+                        help="keep running, regenerating on input changes "
+                        "(not with -R, --since or --staged)")
+    parser.add_argument("--interval", type=float,
+                        default=watch.WATCH_INTERVAL,
+                        help="seconds between checks for changes in --watch")
+    parser.add_argument("--serve", default=False, action="store_true",
+                        help="keep running, answering JSON-RPC requests on "
+                        "stdin/stdout (or --socket)")
+    parser.add_argument("--socket", metavar="PATH",
+                        help="with --serve, listen on a Unix socket at PATH")
     parser.add_argument("-o", "--output",
-                        help="file to write extracted vars to")
+                        help="file to write extracted vars to, or - for "
+                        "stdout (logging goes to stderr)")
+    parser.add_argument("-q", "--quiet", default=False, action="store_true",
+                        help="only log warnings")
     parser.add_argument("-f", "--force", default=False, action="store_true",
                         help="overwrite existing out file")
+    parser.add_argument("--stats", default=False, action="store_true",
+                        help="print per-phase timings and counters to stderr")
+    parser.add_argument("--profile", choices=("cpu", "memory"),
+                        help="print a CPU or memory profile to stderr")
+    parser.add_argument("--profile-output", metavar="FILE",
+                        help="with --profile, also save the raw profile "
+                        "(pstats or tracemalloc snapshot) to FILE")
+    parser.add_argument("-k", "--keep", type=int, metavar="N",
+                        help="when not forcing, keep only the newest N "
+                        "numbered out files, removing older ones")
+    parser.add_argument("-u", "--update", default=False, action="store_true",
+                        help="merge into an existing variables file in "
+                        "place, keeping its declarations as they are and "
+                        "adding new ones, instead of writing a numbered copy")
+    parser.add_argument("--prune", choices=("drop", "comment"),
+                        help="with --update, drop or comment out the "
+                        "declarations of vars no longer used")
 
     task = parser.add_mutually_exclusive_group()
     task.add_argument("-m", "--modstub", default=False, action="store_true",
@@ -43,24 +108,142 @@ def parse_args(args):
                       help="generate .tfvars with Terraform vars")
     task.add_argument("--template", default=False, action="store_true",
                       help="generate .tf from Terraform template vars")
+    task.add_argument("-A", "--all", default=False, action="store_true",
+                      help="from one scan of each -I module directory (or "
+                      "here), generate variables.tf, modstub.tf, .env, "
+                      "terraform.tfvars and, for templatefile() templates, "
+                      "template_vars.tf in it")
+
+    parser.add_argument("-R", "--recursive", default=False,
+                        action="store_true",
+                        help="with --check, check every module directory "
+                        "under the input directories (or here); with "
+                        "--modstub, write stubs into every local module "
+                        "they call, rewriting only those that changed; with "
+                        "--all, write all files into every module directory; "
+                        "otherwise, write the output into every module "
+                        "directory, reading and writing --jobs at a time")
+    changed = parser.add_mutually_exclusive_group()
+    changed.add_argument("--since", metavar="REF",
+                         help="with --check or the default task, only use "
+                         "modules with files changed since the git REF")
+    changed.add_argument("--staged", default=False, action="store_true",
+                         help="with --check or the default task, only use "
+                         "modules with files staged in git")
+    parser.add_argument("--report", metavar="FILE",
+                        help="with --check --recursive, write a report of "
+                        "missing and unused vars per module to FILE")
+    parser.add_argument("--report-format", choices=("json", "junit"),
+                        default="json", help="format of --report")
+    parser.add_argument("--dry-run", default=False, action="store_true",
+                        help="with --remove, list files instead of removing")
+    parser.add_argument("--ignore-dir", action="append", default=[],
+                        dest="ignore_dirs", metavar="NAME",
+                        help="with --remove, also skip directories named "
+                        "NAME (.git, .terraform, node_modules always are)")
+    parser.add_argument("--exclude", action="append", default=[],
+                        dest="excludes", metavar="PATTERN",
+                        help="with --remove, skip paths matching the "
+                        ".gitignore-style PATTERN")
+    parser.add_argument("--exclude-from", metavar="FILE",
+                        help="with --remove, skip paths matching the "
+                        "patterns in FILE, e.g. a .gitignore")
 
     sort_order = parser.add_mutually_exclusive_group()
     sort_order.add_argument("-a", "--asc", action="store_true",
                             help="sort output variables in ascending order")
     sort_order.add_argument("-d", "--desc", action="store_true",
                             help="sort output variables in descending order")
+    parser.add_argument("-N", "--natural", default=False, action="store_true",
+                        help="with -a or -d, sort numbers in names by value "
+                        "(var2 before var10)")
+
+    args = parser.parse_args(args)
+    # watching only reruns the task on the input files; these select other
+    # files, or modules, to run it on
+    if args.watch:
+        for flag, value in (("-R/--recursive", args.recursive),
+                            ("--since", args.since),
+                            ("--staged", args.staged)):
+            if value:
+                parser.error("argument -w/--watch: not allowed with "
+                             "argument {}".format(flag))
+    return args
+
 
-    return parser.parse_args(args)
+PROFILE_LIMIT = 25
 
 
 def main():
     """Entry point for scratchrelaxtv CLI."""
     args = parse_args(sys.argv[1:])
+    # keep log messages out of output (and responses) written to stdout
+    scratchrelaxtv.configure_logging(args.quiet, sys.stderr if (
+        args.output == "-" or args.serve and not args.socket) else None)
+
+    with contextlib.ExitStack() as stack:
+        if args.stats:
+            stats = stack.enter_context(scratchrelaxtv.collect_stats())
+            stack.callback(lambda: sys.stderr.write(stats.render()))
+        if args.profile:
+            stack.enter_context(profile(args.profile, args.profile_output))
+        code = run(args)
+    sys.exit(code)
+
 
+@contextlib.contextmanager
+def profile(kind, output=None):
+    """Profile the with block, printing the top entries to stderr."""
+    if kind == "cpu":
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if output:
+                profiler.dump_stats(output)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+                "cumulative").print_stats(PROFILE_LIMIT)
+        return
+
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if output:
+            snapshot.dump(output)
+        sys.stderr.write("peak traced memory: {} bytes\n".format(peak))
+        for stat in snapshot.statistics("lineno")[:PROFILE_LIMIT]:
+            sys.stderr.write("{}\n".format(stat))
+
+
+def run(args):
+    """Run the task args ask for; return the exit code."""
     extractor = None
+    if args.serve:
+        from scratchrelaxtv import server
+        return server.serve(args)
     if args.remove:
-        scratchrelaxtv.remove_files()
-        sys.exit(scratchrelaxtv.EXIT_OKAY)
+        excludes = list(args.excludes)
+        if args.exclude_from:
+            with open(args.exclude_from, "r") as file_handle:
+                excludes.extend(file_handle.read().splitlines())
+        removable = scratchrelaxtv.remove_files(
+            ignore_dirs=scratchrelaxtv.IGNORE_DIRS + tuple(args.ignore_dirs),
+            excludes=excludes,
+            dry_run=args.dry_run,
+            jobs=args.jobs)
+        if args.dry_run:
+            for path in removable:
+                print(path)
+        return scratchrelaxtv.EXIT_OKAY
     elif args.modstub:
         extractor = scratchrelaxtv.StubMaker(args)
     elif args.check:
@@ -69,10 +252,15 @@ def main():
         extractor = scratchrelaxtv.EnvGenerator(args)
     elif args.template:
         extractor = scratchrelaxtv.TemplateExtractor(args)
+    elif args.all:
+        extractor = scratchrelaxtv.ArtifactMaker(args)
     else:
         extractor = scratchrelaxtv.VarExtractor(args)
 
-    sys.exit(extractor.extract())
+    if args.watch:
+        return watch.Watcher(extractor, args.interval).run()
+
+    return extractor.extract()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""scratchrelaxtv HCL2 lexer and variable index.
+
+A small, hand-written lexer for the parts of HCL2 that matter to
+scratchrelaxtv: comments, quoted and heredoc templates (with their
+interpolations and directives), identifiers and block structure. Unlike the
+regex scanners, it knows whether text is live code, a comment or a string
+literal, so a commented-out ``var.x`` or a literal ``"var.x"`` is not a use.
+
+The VariableIndex built from the tokens maps each variable to where it is
+declared, which attributes its block sets, and everywhere it is used, and
+records each module block with its source and the inputs it passes.
+"""
+
+import collections
+import re
+
+
+Token = collections.namedtuple("Token", "kind value line column")
+Location = collections.namedtuple("Location", "filename line column")
+Declaration = collections.namedtuple(
+    "Declaration", "name location attributes")
+ModuleCall = collections.namedtuple(
+    "ModuleCall", "name source arguments location")
+
+IDENT = re.compile(r'[a-zA-Z_][a-zA-Z0-9_-]*')
+NUMBER = re.compile(r'[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?')
+HEREDOC = re.compile(r'<<(-?)([a-zA-Z_][a-zA-Z0-9_-]*)[ \t]*\r?\n')
+QUOTED_CHUNK = re.compile(r'[^"\\$%\n]+')
+HEREDOC_CHUNK = re.compile(r'[^$%\n]+')
+
+# traversal roots and the kind of reference each one makes
+REFERENCE_ROOTS = {"var": "var", "local": "local", "module": "module"}
+
+# module block arguments that are not inputs of the module
+MODULE_META_ARGUMENTS = frozenset((
+    "source", "version", "providers", "count", "for_each", "depends_on"))
+
+
+class Lexer():
+    """
+    A class that turns HCL2 text into a flat stream of tokens.
+
+    Comments are dropped. Each quoted or heredoc template becomes a single
+    "string" token whose value is its literal text, or None if it contains
+    interpolations; the tokens of those interpolations are emitted before
+    it. Braces inside interpolations are not emitted, so "{" and "}" tokens
+    always delimit blocks and object constructors.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.line = 1
+        self.line_start = 0
+
+    def _advance_to(self, end):
+        newline = self.text.rfind("\n", self.pos, end)
+        if newline != -1:
+            self.line += self.text.count("\n", self.pos, end)
+            self.line_start = newline + 1
+        self.pos = end
+
+    def _token(self, kind, value):
+        return Token(kind, value, self.line, self.pos - self.line_start + 1)
+
+    def tokens(self):
+        """Yield the tokens of the text."""
+        yield from self._expression(False)
+
+    def _expression(self, in_template):
+        """Yield tokens up to the end of text or of an interpolation."""
+        text = self.text
+        nesting = 0
+        while self.pos < len(text):
+            char = text[self.pos]
+            if char == "\n":
+                yield self._token("newline", char)
+                self._advance_to(self.pos + 1)
+            elif char in " \t\r":
+                self.pos += 1
+            elif char == "#" or text.startswith("//", self.pos):
+                end = text.find("\n", self.pos)
+                self.pos = len(text) if end == -1 else end
+            elif text.startswith("/*", self.pos):
+                end = text.find("*/", self.pos + 2)
+                self._advance_to(len(text) if end == -1 else end + 2)
+            elif char == '"':
+                yield from self._template(quoted=True)
+            elif char == "<" and HEREDOC.match(text, self.pos):
+                yield from self._heredoc(HEREDOC.match(text, self.pos))
+            elif IDENT.match(text, self.pos):
+                match = IDENT.match(text, self.pos)
+                yield self._token("ident", match.group())
+                self.pos = match.end()
+            elif NUMBER.match(text, self.pos):
+                match = NUMBER.match(text, self.pos)
+                yield self._token("number", match.group())
+                self.pos = match.end()
+            elif in_template and char in "{}":
+                # braces inside an interpolation are not block structure
+                if char == "{":
+                    nesting += 1
+                elif not nesting:
+                    self.pos += 1
+                    return
+                else:
+                    nesting -= 1
+                self.pos += 1
+            else:
+                yield self._token("punct", char)
+                self.pos += 1
+
+    def _template(self, quoted, end=None):
+        """Yield the tokens of a quoted or heredoc template."""
+        text = self.text
+        line, column = self.line, self.pos - self.line_start + 1
+        literal = []
+        interpolated = False
+        chunk = QUOTED_CHUNK if quoted else HEREDOC_CHUNK
+        if quoted:
+            self.pos += 1
+            end = len(text)
+
+        while self.pos < end:
+            match = chunk.match(text, self.pos, end)
+            if match:
+                literal.append(match.group())
+                self.pos = match.end()
+                continue
+            char = text[self.pos]
+            if quoted and char == '"':
+                self.pos += 1
+                break
+            elif quoted and char == "\n":
+                # unterminated; quoted templates cannot span lines
+                break
+            elif quoted and char == "\\":
+                literal.append(text[self.pos:self.pos + 2])
+                self.pos += 2
+            elif text.startswith(("$${", "%%{"), self.pos):
+                literal.append(text[self.pos + 1:self.pos + 3])
+                self.pos += 3
+            elif text.startswith(("${", "%{"), self.pos):
+                interpolated = True
+                self.pos += 2
+                yield from self._expression(True)
+            elif char == "\n":
+                literal.append(char)
+                self._advance_to(self.pos + 1)
+            else:
+                literal.append(char)
+                self.pos += 1
+
+        yield Token(
+            "string", None if interpolated else "".join(literal), line,
+            column)
+
+    def _heredoc(self, match):
+        """Yield the tokens of a heredoc template."""
+        marker = re.compile(
+            r'^[ \t]*' + re.escape(match.group(2)) + r'[ \t]*\r?$',
+            re.MULTILINE)
+        self._advance_to(match.end())
+        closing = marker.search(self.text, self.pos)
+        end = closing.start() if closing else len(self.text)
+        yield from self._template(quoted=False, end=end)
+        self._advance_to(closing.end() if closing else end)
+
+
+class VariableIndex():
+    """
+    A class that indexes the variables declared and used in HCL2 files.
+
+    Add files with add(); then look up declarations (with their location
+    and the attributes their blocks set), usage sites and module calls by
+    name.
+    """
+
+    def __init__(self):
+        self.declarations = collections.OrderedDict()
+        self.usages = collections.OrderedDict()
+        self.modules = collections.OrderedDict()
+        self.references = {
+            kind: collections.OrderedDict() for kind in ("local", "module")}
+
+    def add(self, text, filename=None):
+        """Index the declarations and uses in text."""
+        tokens = list(Lexer(text).tokens())
+        depth = 0
+        block = None
+        for index, token in enumerate(tokens):
+            previous = tokens[index - 1] if index else None
+            following = tokens[index + 1:index + 5]
+            if token.kind == "punct" and token.value == "{":
+                depth += 1
+            elif token.kind == "punct" and token.value == "}":
+                depth -= 1
+                if block and not depth:
+                    self._declare(*block)
+                    block = None
+            elif token.kind != "ident" or _is_punct(previous, "."):
+                continue
+            elif token.value in REFERENCE_ROOTS and _is_traversal(following):
+                self._use(token, following, filename)
+            elif not depth and token.value in ("variable", "module")\
+                    and _is_label(following):
+                block = (token.value, following[0].value,
+                         Location(filename, token.line, token.column), [],
+                         {})
+            elif block and depth == 1 and _starts_line(previous)\
+                    and following and (
+                        _is_punct(following[0], "=")
+                        or _is_punct(following[0], "{")):
+                block[3].append(token.value)
+                if len(following) > 1 and following[1].kind == "string":
+                    block[4][token.value] = following[1].value
+
+        if block:
+            self._declare(*block)
+        return self
+
+    def _declare(self, kind, name, location, attributes, literals):
+        if kind == "module":
+            if name not in self.modules:
+                self.modules[name] = ModuleCall(
+                    name, literals.get("source"),
+                    tuple(attribute for attribute in attributes
+                          if attribute not in MODULE_META_ARGUMENTS),
+                    location)
+        elif name not in self.declarations:
+            self.declarations[name] = Declaration(
+                name, location, tuple(attributes))
+
+    def _use(self, token, following, filename):
+        kind = REFERENCE_ROOTS[token.value]
+        name = following[1].value
+        location = Location(filename, token.line, token.column)
+        if kind == "var":
+            self.usages.setdefault(name, []).append(location)
+            return
+        if kind == "module" and _is_traversal(following[2:]):
+            name = "{}.{}".format(name, following[3].value)
+        self.references[kind].setdefault(name, []).append(location)
+
+    def missing(self):
+        """Return the names used but not declared, in order of use."""
+        return [name for name in self.usages if name not in self.declarations]
+
+    def unused(self):
+        """Return the names declared but not used, in order of declaration."""
+        return [name for name in self.declarations if name not in self.usages]
+
+    def refs(self):
+        """Return the indexed names by kind, like scratchrelaxtv.scan()."""
+        return {
+            "var": list(self.usages),
+            "variable": list(self.declarations),
+            "local": list(self.references["local"]),
+            "module": list(self.references["module"]),
+        }
+
+
+def _is_punct(token, value):
+    return token is not None and token.kind == "punct" and token.value == value
+
+
+def _is_traversal(following):
+    return len(following) >= 2 and _is_punct(following[0], ".")\
+        and following[1].kind == "ident"
+
+
+def _is_label(following):
+    return len(following) >= 2 and following[0].kind == "string"\
+        and following[0].value and _is_punct(following[1], "{")
+
+
+def _starts_line(previous):
+    return previous is None or previous.kind == "newline"\
+        or _is_punct(previous, "{")
+
+
+def variable_blocks(text):
+    """Return (name, start, end) for each top-level variable block in text.
+
+    start is the offset of the start of the line the block starts on, and
+    end the offset just past the line it ends on, so text[start:end] is
+    the block's lines, byte for byte.
+    """
+    line_starts = [0] + [match.end() for match in re.finditer("\n", text)]
+    blocks = []
+    depth = 0
+    block = None
+    tokens = list(Lexer(text).tokens())
+    for index, token in enumerate(tokens):
+        if token.kind != "punct" and token.kind != "ident":
+            continue
+        if token.value == "{" and token.kind == "punct":
+            depth += 1
+        elif token.value == "}" and token.kind == "punct":
+            depth -= 1
+            if block and not depth:
+                end = line_starts[token.line] if token.line < len(
+                    line_starts) else len(text)
+                blocks.append((block[0], block[1], end))
+                block = None
+        elif not depth and token.value == "variable"\
+                and _is_label(tokens[index + 1:index + 3]):
+            block = (tokens[index + 1].value, line_starts[token.line - 1])
+    return blocks
+
+
+def scan(text):
+    """Return all references in text, by kind, like scratchrelaxtv.scan()."""
+    return VariableIndex().add(text).refs()
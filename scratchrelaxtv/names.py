@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""scratchrelaxtv interned name table.
+
+For checking whole repositories, where millions of references name a few
+thousand variables. Each distinct name is stored once, in a NameTable,
+and given a small integer ID. Each file's uses and declarations are kept
+as Postings, arrays of those IDs at 4 bytes a reference, rather than as
+lists of strings of their own. Comparing uses with declarations is then
+set arithmetic on integers.
+
+Example:
+    Compare the uses and declarations of two files::
+
+        >>> from scratchrelaxtv import names
+        >>> table = names.NameTable()
+        >>> main = table.postings(["a", "b"], [])
+        >>> variables = table.postings([], ["b", "c"])
+        >>> list(main.used), list(variables.declared)
+        ([0, 1], [1, 2])
+        >>> table.compare([main, variables])
+        (['a'], ['c'])
+"""
+
+import array
+import itertools
+
+
+# unsigned int: 4 bytes on all common platforms
+TYPECODE = "I"
+
+
+class Postings():
+    """The IDs of the names one file uses and declares, in order."""
+
+    __slots__ = ("used", "declared")
+
+    def __init__(self, used, declared):
+        self.used = used
+        self.declared = declared
+
+    def __repr__(self):
+        return "Postings(used={}, declared={})".format(
+            list(self.used), list(self.declared))
+
+
+class NameTable():
+    """
+    A class that gives each distinct name an integer ID.
+
+    IDs are assigned in first-seen order, from 0.
+    """
+
+    __slots__ = ("ids", "names")
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def intern(self, name):
+        """Return the ID of name, adding it if it is new."""
+        name_id = self.ids.get(name)
+        if name_id is None:
+            name_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def array(self, names):
+        """Return an array of the IDs of names."""
+        return array.array(TYPECODE, map(self.intern, names))
+
+    def postings(self, used, declared):
+        """Return the Postings of the used and declared names of a file."""
+        return Postings(self.array(used), self.array(declared))
+
+    def lookup(self, ids):
+        """Return the names of ids."""
+        return [self.names[name_id] for name_id in ids]
+
+    def compare(self, file_postings):
+        """Compare the uses with the declarations of many files.
+
+        Returns the names used but not declared (missing) and declared but
+        not used (unused), each in first-seen order.
+        """
+        used = dict.fromkeys(itertools.chain.from_iterable(
+            postings.used for postings in file_postings))
+        declared = dict.fromkeys(itertools.chain.from_iterable(
+            postings.declared for postings in file_postings))
+        return (
+            self.lookup(name_id for name_id in used
+                        if name_id not in declared),
+            self.lookup(name_id for name_id in declared
+                        if name_id not in used))
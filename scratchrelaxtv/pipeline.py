@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""scratchrelaxtv asynchronous I/O pipeline.
+
+For many modules on a slow (e.g. network) filesystem, where waiting on
+reads and writes costs more than scanning. Each module's files are read
+and scanned on a pool of threads, so that many reads are in flight at
+once, and its output is written on the same pool while later modules are
+still being read.
+
+Concurrency is bounded by jobs: at most jobs modules are being read at a
+time, and a queue of at most jobs scanned modules sits between reading
+and writing, so reading waits (backpressure) rather than piling results
+up in memory when writes fall behind.
+
+Example:
+    Write a variables.tf into every module::
+
+        >>> from scratchrelaxtv import pipeline
+        >>> results = pipeline.run(pipeline.extract_modules(  # doctest: +SKIP
+        ...     ["modules/a", "modules/b"], jobs=16, force=True))
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import os
+
+import scratchrelaxtv
+
+
+def default_jobs():
+    """Return the default number of concurrent reads and writes."""
+    # like ThreadPoolExecutor: I/O-bound work can use more than one per CPU
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+def run(coroutine):
+    """Run coroutine to completion on a new event loop; return its result.
+
+    Like asyncio.run(), which needs Python 3.7.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+async def scan_files(filenames, syntax="hcl", cache=None, executor=None):
+    """Scan files on executor's threads; return their refs in order.
+
+    Like scratchrelaxtv.scan_files(), but awaitable. The cache is only
+    touched from the event loop thread.
+    """
+    loop = asyncio.get_event_loop()
+    results = {}
+    pending = []
+    for filename in filenames:
+        refs = cache.lookup(filename, syntax) if cache else None
+        if refs is None:
+            pending.append(filename)
+        else:
+            results[filename] = refs
+            scratchrelaxtv._count(cache_hits=1)
+
+    scans = await asyncio.gather(*(
+        loop.run_in_executor(
+            executor, scratchrelaxtv._scan_path, filename, syntax,
+            cache.digest(filename, syntax) if cache else None)
+        for filename in pending))
+    for filename, scanned in zip(pending, scans):
+        results[filename] = scratchrelaxtv._record_scan(
+            filename, syntax, scanned, cache)
+    return [results[filename] for filename in filenames]
+
+
+def _write(output, content, force, keep):
+    output = scratchrelaxtv.next_output(output, force, keep)
+    scratchrelaxtv.write_output(output, content)
+    return output
+
+
+def _update(output, tf_vars, types, prune):
+    try:
+        with open(output, "rb") as file_handle:
+            text = file_handle.read().decode("utf_8", "surrogateescape")
+    except FileNotFoundError:
+        return None
+    scratchrelaxtv.write_output(output, scratchrelaxtv.update_variables(
+        text, tf_vars, types=types, prune=prune, keep=set(tf_vars)),
+        raw=True)
+    return output
+
+
+async def extract_modules(module_dirs, kind="var", filename="variables.tf",
+                          render=scratchrelaxtv.render_variables,
+                          parser="regex", order=None, natural=False,
+                          force=False, keep=None, jobs=None, cache=None,
+                          infer=False, update=False, prune=None):
+    """Extract vars from each module and write render(vars) into it.
+
+    Each module's vars are extracted from its .tf files, as by
+    scratchrelaxtv.extract_vars(), and written to filename in the module
+    (or to the next numbered copy, unless forcing; see next_output()). With
+    render of None, nothing is written. With infer, types are inferred from
+    the vars' uses and render is called as render(vars, types). With update,
+    an existing variables file is merged into in place instead, as by
+    scratchrelaxtv.update_variables(), pruning as prune says. Returns an
+    OrderedDict of module directory to its vars, in the order given.
+
+    A module that cannot be read or written is logged and skipped, and the
+    rest are still done; the first such error is then raised.
+    """
+    jobs = jobs or default_jobs()
+    loop = asyncio.get_event_loop()
+    syntax = scratchrelaxtv._syntax_for(kind, parser, infer)
+    results = collections.OrderedDict.fromkeys(module_dirs)
+    reading = asyncio.Semaphore(jobs)
+    scanned = asyncio.Queue(maxsize=jobs)
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        async def read(module_dir):
+            try:
+                async with reading:
+                    filenames = await loop.run_in_executor(
+                        executor, scratchrelaxtv.find_input_files,
+                        [module_dir])
+                    file_refs = await scan_files(
+                        filenames, syntax, cache, executor)
+            except OSError as err:
+                # keep reading the other modules; raised at the end
+                scratchrelaxtv.logger.error(
+                    "could not read %s: %s", module_dir, err)
+                errors.append(err)
+                return
+            tf_vars = scratchrelaxtv._sorted(
+                scratchrelaxtv.merge_refs(file_refs, kind), order, natural)
+            types = scratchrelaxtv.merge_types(file_refs) if infer else None
+            # waits here while the writers are jobs modules behind
+            await scanned.put((module_dir, tf_vars, types))
+
+        async def write():
+            while True:
+                module_dir, tf_vars, types = await scanned.get()
+                results[module_dir] = tf_vars
+                output = os.path.join(module_dir, filename)
+                try:
+                    if render and update and await loop.run_in_executor(
+                            executor, _update, output, tf_vars, types, prune):
+                        scratchrelaxtv.logger.info("updated %s", output)
+                    elif render:
+                        content = (render(tf_vars, types) if infer
+                                   else render(tf_vars))
+                        output = await loop.run_in_executor(
+                            executor, _write, output, content, force, keep)
+                        scratchrelaxtv.logger.info("wrote %s", output)
+                except OSError as err:
+                    # keep writing the other modules; raised at the end
+                    scratchrelaxtv.logger.error(
+                        "could not write %s: %s", output, err)
+                    errors.append(err)
+                finally:
+                    scanned.task_done()
+
+        errors = []
+        writers = [asyncio.ensure_future(write()) for _ in range(jobs)]
+        readers = [asyncio.ensure_future(read(module_dir))
+                   for module_dir in module_dirs]
+        try:
+            await asyncio.gather(*readers)
+            await scanned.join()
+        finally:
+            for task in readers + writers:
+                task.cancel()
+            await asyncio.gather(*readers, *writers, return_exceptions=True)
+    if errors:
+        raise errors[0]
+    return results
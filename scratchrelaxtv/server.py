@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""scratchrelaxtv server.
+
+A long-running process for editor plugins and pre-commit hooks that call
+scratchrelaxtv many times a minute. It answers JSON-RPC 2.0 requests, one
+JSON object per line, on stdin/stdout or on a Unix socket, and keeps the
+vars cache in memory between requests, so unchanged files are neither read
+nor scanned again and no request pays interpreter start-up.
+
+Methods take the parameters of the library functions they wrap:
+    extract   extract_vars(); returns {"vars": [...]}
+    check     check_vars(); returns {"missing": [...], "unused": [...]}
+    variables, modstub, env, tfvars, template
+              extract the vars of the matching kind from text/paths and
+              return {"vars": [...], "content": "..."} rendered as that file
+    stats     returns counts of requests and cache hits and misses
+    shutdown  saves the cache and stops the server
+
+Relative paths are resolved against the "cwd" parameter, if given.
+
+Example:
+    Serve on a socket, then query it::
+
+        $ relaxtv --serve --socket /tmp/relaxtv.sock &
+        >>> from scratchrelaxtv import server
+        >>> server.request(  # doctest: +SKIP
+        ...     "/tmp/relaxtv.sock", "check", paths=["main.tf"], cwd="/src")
+        {'missing': ['region'], 'unused': []}
+"""
+
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+
+import scratchrelaxtv
+
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+# method: (kind of vars, renderer); modstub also takes the module name
+RENDER_METHODS = {
+    "variables": ("var", scratchrelaxtv.render_variables),
+    "modstub": ("variable", scratchrelaxtv.render_modstub),
+    "env": ("var", scratchrelaxtv.render_env),
+    "tfvars": ("var", scratchrelaxtv.render_tfvars),
+    "template": ("template", scratchrelaxtv.render_template_vars),
+}
+
+# parameter: the values it may take
+PARAM_CHOICES = {
+    "kind": tuple(scratchrelaxtv.KIND_SYNTAX),
+    "order": (None, "asc", "desc"),
+    "parser": ("regex", "hcl"),
+}
+
+
+class ServerError(Exception):
+    """An error response from a scratchrelaxtv server."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class Server():
+    """
+    A class that answers scratchrelaxtv JSON-RPC requests.
+
+    One cache is shared by all requests and connections; requests are
+    handled one at a time.
+    """
+
+    def __init__(self, cache=None, jobs=None):
+        self.cache = cache
+        self.jobs = jobs
+        self.requests = 0
+        self.running = True
+        self.lock = threading.Lock()
+
+    def handle(self, line):
+        """Answer one request line; return the response line, if any."""
+        try:
+            request = json.loads(line)
+        except ValueError as err:
+            return _response(None, error=(PARSE_ERROR, str(err)))
+        if not isinstance(request, dict) or not isinstance(
+                request.get("method"), str):
+            return _response(None, error=(INVALID_REQUEST, "not a request"))
+
+        params = request.get("params") or {}
+        try:
+            if not isinstance(params, dict):
+                raise TypeError("params must be an object")
+            with self.lock:
+                self.requests += 1
+                result = self.dispatch(request["method"], dict(params))
+        except ServerError as err:
+            response = _response(request.get("id"), error=(err.code, err))
+        except (TypeError, ValueError) as err:
+            response = _response(
+                request.get("id"), error=(INVALID_PARAMS, err))
+        except OSError as err:
+            response = _response(request.get("id"), error=(SERVER_ERROR, err))
+        except Exception as err:  # pylint: disable=broad-except
+            # a bug answers this request with an error; the server stays up
+            scratchrelaxtv.logger.exception(
+                "error answering %s", request["method"])
+            response = _response(request.get("id"), error=(SERVER_ERROR, err))
+        else:
+            response = _response(request.get("id"), result)
+
+        # requests without an id are notifications and get no response
+        return response if "id" in request else None
+
+    def dispatch(self, method, params):
+        """Run method with params; return its result."""
+        for name, choices in PARAM_CHOICES.items():
+            if name in params and params[name] not in choices:
+                raise ServerError(
+                    INVALID_PARAMS, "{} must be one of {}".format(
+                        name, ", ".join(map(json.dumps, choices))))
+        cwd = params.pop("cwd", None)
+        for name in ("paths", "variables_paths"):
+            if cwd and params.get(name) is not None:
+                params[name] = [os.path.join(cwd, path)
+                                for path in params[name]]
+
+        if method == "extract":
+            return {"vars": scratchrelaxtv.extract_vars(
+                jobs=self.jobs, cache=self.cache, **params)}
+        if method == "check":
+            result = scratchrelaxtv.check_vars(
+                jobs=self.jobs, cache=self.cache, **params)
+            return result._asdict()
+        if method in RENDER_METHODS:
+            kind, render = RENDER_METHODS[method]
+            render_args = ()
+            if method == "modstub":
+                render_args = (params.pop("modname", None) or os.path.basename(
+                    os.path.abspath(cwd or os.getcwd())),)
+            tf_vars = scratchrelaxtv.extract_vars(
+                kind=kind, jobs=self.jobs, cache=self.cache, **params)
+            return {"vars": tf_vars, "content": render(tf_vars, *render_args)}
+        if method == "stats":
+            return {
+                "requests": self.requests,
+                "cache_hits": self.cache.hits if self.cache else 0,
+                "cache_misses": self.cache.misses if self.cache else 0,
+                "cache_entries": len(self.cache.entries) if self.cache else 0,
+            }
+        if method == "shutdown":
+            self.running = False
+            self.save()
+            return None
+        raise ServerError(METHOD_NOT_FOUND, "no method {}".format(method))
+
+    def save(self):
+        """Save the cache to disk."""
+        if self.cache:
+            self.cache.save()
+
+    def serve_stdio(self, stdin=None, stdout=None):
+        """Answer request lines from stdin until EOF or shutdown."""
+        stdin = stdin or sys.stdin
+        stdout = stdout or sys.stdout
+        try:
+            for line in stdin:
+                if not line.strip():
+                    continue
+                response = self.handle(line)
+                if response is not None:
+                    stdout.write(response + "\n")
+                    stdout.flush()
+                if not self.running:
+                    break
+        finally:
+            self.save()
+
+    def serve_socket(self, path):
+        """Answer requests on a Unix socket at path until shutdown."""
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            # left behind by a server that did not shut down cleanly
+            os.remove(path)
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            """Answer each request line on a connection."""
+
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    response = server.handle(line.decode("utf_8"))
+                    if response is not None:
+                        self.wfile.write((response + "\n").encode("utf_8"))
+                        self.wfile.flush()
+                    if not server.running:
+                        self.server.shutdown()
+                        return
+
+        socket_server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        socket_server.daemon_threads = True
+        scratchrelaxtv.logger.info("serving on %s", path)
+        try:
+            socket_server.serve_forever()
+        finally:
+            socket_server.server_close()
+            os.remove(path)
+            self.save()
+
+
+def _response(request_id, result=None, error=None):
+    response = {"jsonrpc": "2.0", "id": request_id}
+    if error:
+        response["error"] = {"code": error[0], "message": str(error[1])}
+    else:
+        response["result"] = result
+    return json.dumps(response)
+
+
+def request(path, method, **params):
+    """Send one request to the server on the Unix socket at path.
+
+    Returns the result, or raises ServerError with the server's error.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall((json.dumps({
+            "jsonrpc": "2.0", "id": 1, "method": method,
+            "params": params}) + "\n").encode("utf_8"))
+        with client.makefile("r", encoding="utf_8") as reader:
+            response = json.loads(reader.readline())
+    if "error" in response:
+        raise ServerError(
+            response["error"]["code"], response["error"]["message"])
+    return response["result"]
+
+
+def serve(args):
+    """Serve requests as args ask; return the exit code."""
+    server = Server(
+        None if args.no_cache else scratchrelaxtv.VarCache(args.cache_dir),
+        args.jobs)
+    if not args.socket:
+        server.serve_stdio()
+        return scratchrelaxtv.EXIT_OKAY
+    if not hasattr(socket, "AF_UNIX"):
+        scratchrelaxtv.logger.error("Unix sockets are not available here")
+        return scratchrelaxtv.EXIT_NOT_OKAY
+    try:
+        server.serve_socket(args.socket)
+    except KeyboardInterrupt:
+        pass
+    return scratchrelaxtv.EXIT_OKAY
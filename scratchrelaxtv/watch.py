@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""scratchrelaxtv watch mode.
+
+Keeps running after the first extraction, polling the input files for
+changes. Only files whose size or mtime changed are rescanned; the refs of
+every other file are kept in memory. The output is regenerated (or, for
+the checker, the check is re-reported) only when the vars it depends on
+change, so saving a file without touching its variables does nothing.
+"""
+
+import os
+import time
+
+import scratchrelaxtv
+
+
+WATCH_INTERVAL = 0.5
+
+
+class Watcher():
+    """
+    A class that incrementally re-runs an extractor as its inputs change.
+    """
+
+    def __init__(self, extractor, interval=WATCH_INTERVAL):
+        self.extractor = extractor
+        self.interval = interval
+        self.stats = {}
+        self.file_refs = {}
+        self.tf_vars = None
+
+        # rewrite the same output each time rather than numbering new ones
+        if not isinstance(extractor, scratchrelaxtv.Checker):
+            extractor.args.force = True
+
+    def poll(self):
+        """Rescan changed files and regenerate if the vars changed.
+
+        Returns True if the output was regenerated.
+        """
+        stats = {}
+        changed = []
+        for filename in self.extractor.watched_files():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            stats[filename] = (stat.st_size, stat.st_mtime_ns)
+            if self.stats.get(filename) != stats[filename]:
+                changed.append(filename)
+
+        for filename in set(self.file_refs) - set(stats):
+            del self.file_refs[filename]
+        self.stats = stats
+
+        if changed:
+            scratchrelaxtv.logger.debug(
+                "rescanning changed files: %s", ", ".join(changed))
+            self.file_refs.update(zip(changed, scratchrelaxtv.scan_files(
+                changed,
+                self.extractor.syntax(self.extractor.kind),
+                self.extractor.args.jobs)))
+
+        tf_vars = self.extractor.vars_from_refs(self.file_refs)
+        if tf_vars == self.tf_vars:
+            return False
+
+        self.tf_vars = tf_vars
+        self.extractor.regenerate(tf_vars)
+        return True
+
+    def run(self):
+        """Poll until interrupted."""
+        scratchrelaxtv.logger.info(
+            "watching for changes every %ss (ctrl-c to stop)", self.interval)
+        try:
+            while True:
+                if self.poll():
+                    scratchrelaxtv.logger.info("regenerated output")
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+
+        return scratchrelaxtv.EXIT_OKAY
@@ -3,10 +3,25 @@
 """test_scratchrelaxtv module."""
 
 
+import io
+import json
+import logging
 import os
+import socket
+import subprocess
+import sys
+import threading
+import time
 from contextlib import contextmanager
+from xml.etree import ElementTree
+
+import pytest
+
 from scratchrelaxtv import cli, Checker, StubMaker, VarExtractor,\
-    EnvGenerator, EXIT_OKAY, remove_files, TemplateExtractor
+    EnvGenerator, EXIT_OKAY, remove_files, TemplateExtractor,\
+    find_vars_in_files, VarCache, scan
+import scratchrelaxtv
+from scratchrelaxtv import bench, hcl, names, pipeline, server, watch
 
 
 @contextmanager
@@ -18,6 +33,14 @@ def change_dir(path):
     os.chdir(old_dir)
 
 
+@pytest.fixture(autouse=True)
+def cache_home(tmpdir, monkeypatch):
+    """Keep the vars cache out of the user's home directory."""
+    cache_dir = tmpdir.mkdir("cache")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(cache_dir))
+    return cache_dir
+
+
 def test_var_defaults():
     """Test CLI default arguments."""
     with change_dir("tests"):
@@ -200,3 +223,1016 @@ def test_template():
             second_list = file_handle.read().splitlines()
         assert first_list == second_list
         os.remove(filename)
+
+
+def test_input_dir(tmpdir):
+    """Test extracting variables from a module directory."""
+    tmpdir.join("b.tf").write('x = var.beta\ny = var.alpha\n')
+    tmpdir.join("a.tf").write('x = var.alpha\ny = var.gamma\n')
+
+    args = cli.parse_args(["-f", "-I", str(tmpdir)])
+    extractor = VarExtractor(args)
+
+    assert extractor.args.output == str(tmpdir.join("variables.tf"))
+    assert extractor.extract() == EXIT_OKAY
+    assert extractor.tf_vars == ["alpha", "gamma", "beta"]
+
+
+def test_input_dir_check(tmpdir):
+    """Test checking a module directory for missing variables."""
+    tmpdir.join("main.tf").write('x = var.alpha\ny = var.beta\n')
+    tmpdir.join("variables.tf").write('variable "alpha" {}\n')
+    tmpdir.join("other.tf").write('variable "extra" {}\n')
+
+    args = cli.parse_args(["-c", "-I", str(tmpdir)])
+    missing = Checker(args).find_missing()
+
+    assert missing['main'] == ["beta"]
+    assert missing['var'] == ["extra"]
+
+
+def test_find_vars_parallel(tmpdir):
+    """Test that a parallel scan keeps first-seen order across files."""
+    filenames = []
+    for index in range(20):
+        tf_file = tmpdir.join("{:02d}.tf".format(index))
+        tf_file.write("a = var.v{}\nb = var.shared\n".format(index))
+        filenames.append(str(tf_file))
+
+    tf_vars = find_vars_in_files(filenames, "var", jobs=2)
+
+    assert tf_vars == ["v0", "shared"] + [
+        "v{}".format(i) for i in range(1, 20)]
+
+
+def test_cache(tmpdir):
+    """Test that unchanged files are served from the vars cache."""
+    tf_file = tmpdir.join("main.tf")
+    tf_file.write("a = var.alpha\n")
+    os.utime(str(tf_file), (1, 1))
+    cache = VarCache()
+    assert find_vars_in_files([str(tf_file)], cache=cache) == ["alpha"]
+    assert (cache.hits, cache.misses) == (0, 1)
+    cache.save()
+
+    cache = VarCache()
+    assert find_vars_in_files([str(tf_file)], cache=cache) == ["alpha"]
+    assert (cache.hits, cache.misses) == (1, 0)
+
+    tf_file.write("a = var.beta\n")
+    assert find_vars_in_files([str(tf_file)], cache=cache) == ["beta"]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_stats(tmpdir):
+    """Test that stats count files, matches and cache hits."""
+    tf_file = tmpdir.join("main.tf")
+    tf_file.write("a = var.alpha\nb = var.beta\n# var.gamma\n")
+    os.utime(str(tf_file), (1, 1))
+    cache = VarCache()
+    with scratchrelaxtv.collect_stats() as stats:
+        find_vars_in_files([str(tf_file)], cache=cache)
+        find_vars_in_files([str(tf_file)], cache=cache)
+        scratchrelaxtv.render_variables(["alpha"])
+
+    summary = stats.as_dict()
+    assert summary["files_read"] == 1
+    assert summary["bytes_read"] == tf_file.size()
+    assert summary["matches"] == 2
+    assert (summary["cache_hits"], summary["cache_misses"]) == (1, 1)
+    assert summary["seconds"]["render"] > 0
+    assert "cache_hit_rate" in stats.render()
+    assert not scratchrelaxtv._COLLECTORS
+
+
+def test_cli_stats_profile(tmpdir, monkeypatch, capsys):
+    """Test that --stats and --profile report to stderr."""
+    tmpdir.join("main.tf").write("a = var.alpha\n")
+    profile = tmpdir.join("profile.out")
+    monkeypatch.setattr(scratchrelaxtv, "configure_logging",
+                        lambda quiet=False, stream=None: None)
+    with change_dir(str(tmpdir)):
+        for argv in (["--stats"],
+                     ["--profile", "cpu", "--profile-output", str(profile)],
+                     ["--profile", "memory"]):
+            monkeypatch.setattr(sys, "argv", ["scratchrelaxtv", "-f"] + argv)
+            with pytest.raises(SystemExit) as exit_info:
+                cli.main()
+            assert exit_info.value.code == EXIT_OKAY
+            assert capsys.readouterr().err
+
+    assert profile.check()
+
+
+def test_cache_eviction(tmpdir):
+    """Test that the least recently used entries are evicted."""
+    cache = VarCache(str(tmpdir), max_entries=2)
+    for name in ("a", "b", "c"):
+        cache.store(name, "hcl", {"var": [name]}, 1, 1, name)
+
+    assert [os.path.basename(key) for key in cache.entries] == ["b", "c"]
+
+    # a hit makes an entry the most recently used, and is saved
+    cache.lookup("b", "hcl")
+    cache.save()
+    cache = VarCache(str(tmpdir), max_entries=2)
+    cache.store("d", "hcl", {"var": ["d"]}, 1, 1, "d")
+    assert [os.path.basename(key) for key in cache.entries] == ["b", "d"]
+
+    # and past max_dirs, the directories used least recently
+    cache = VarCache(str(tmpdir.mkdir("dirs")), max_dirs=2)
+    shards = []
+    for used, name in enumerate("xyzw"):
+        cache.store(os.path.join(name, "main.tf"), "hcl", {}, 1, 1, name)
+        cache.save()
+        shards.append(cache._shard_path(os.path.abspath(name)))
+        os.utime(shards[-1], (used, used))
+    assert sorted(os.listdir(cache.path)) == sorted(
+        os.path.basename(shard) for shard in shards[2:])
+
+
+def test_cache_shards(tmpdir, monkeypatch):
+    """Test that only the directories looked up are read and written."""
+    modules = [tmpdir.mkdir(name) for name in ("a", "b")]
+    for module in modules:
+        module.join("main.tf").write("a = var.alpha\n")
+        os.utime(str(module.join("main.tf")), (1, 1))
+    cache = VarCache()
+    find_vars_in_files([str(module.join("main.tf")) for module in modules],
+                       cache=cache)
+    cache.save()
+    assert len(os.listdir(cache.path)) == 2
+
+    cache = VarCache()
+    assert find_vars_in_files([str(modules[0].join("main.tf"))],
+                              cache=cache) == ["alpha"]
+    assert cache.hits == 1
+    assert list(cache.shards) == [str(modules[0])]
+    assert not cache.dirty
+
+    # refs found by other scanners are not used
+    monkeypatch.setattr(scratchrelaxtv, "cache_version", lambda: "other")
+    cache = VarCache()
+    find_vars_in_files([str(modules[0].join("main.tf"))], cache=cache)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_no_cache(tmpdir, cache_home):
+    """Test that --no-cache neither reads nor writes the cache."""
+    tmpdir.join("main.tf").write("a = var.alpha\n")
+    args = cli.parse_args(["-f", "--no-cache", "-I", str(tmpdir)])
+    extractor = VarExtractor(args)
+
+    assert extractor.extract() == EXIT_OKAY
+    assert extractor.cache is None
+    assert not cache_home.listdir()
+
+
+def test_scan():
+    """Test finding every kind of reference in a single pass."""
+    refs = scan(
+        'variable "declared" {}\n'
+        'a = var.used  # var.commented\n'
+        '// var.slashed\n'
+        '/* var.blocked\n var.still_blocked */\n'
+        'b = "https://${var.host}/*"\n'
+        'c = local.thing\n'
+        'd = module.vpc.id\n')
+
+    assert refs == {
+        "var": ["used", "host"],
+        "variable": ["declared"],
+        "local": ["thing"],
+        "module": ["vpc.id"],
+    }
+    assert scan("${a_b} $${escaped} ${c_d}", "template") == {
+        "template": ["a_b", "c_d"]}
+
+
+QUOTED_MAIN = (
+    'resource "aws_instance" "this" {\n'
+    '  ami       = var.ami\n'
+    '  user_data = <<-EOT\n'
+    '    cp x /* ${var.a}  # ${var.b}\n'
+    '    echo // ${var.c}\n'
+    '  EOT\n'
+    '  instance_type = var.instance_type\n'
+    '  name          = "${var.p} #${var.s}"\n'
+    '  url           = "http://host//${var.u}"\n'
+    '  joined        = "${join("#", var.k)}"\n'
+    '  schedule      = "cron(*/5 * * * ? *)"  # var.commented\n'
+    '}\n')
+
+
+def test_scan_quoted(tmpdir):
+    """Test that comment markers in strings and heredocs are not comments."""
+    expected = ["ami", "a", "b", "c", "instance_type", "p", "s", "u", "k"]
+    for syntax in ("hcl", "typed", "module"):
+        assert scan(QUOTED_MAIN, syntax)["var"] == expected
+        assert scan(QUOTED_MAIN.encode("utf_8"), syntax)["var"] == expected
+    assert scan('a = "/*" # "*/ var.commented"\nb = var.b\n') == {
+        "var": ["b"], "variable": [], "local": [], "module": []}
+    assert scan('m = var.m["key"] # var.x\n', "typed")["types"] == {
+        "m": "map"}
+
+    tmpdir.join("main.tf").write(QUOTED_MAIN)
+    tmpdir.join("variables.tf").write("".join(
+        'variable "{}" {{}}\n'.format(name) for name in expected))
+    args = cli.parse_args(["-cu", "--prune", "drop", "-I", str(tmpdir)])
+    assert Checker(args).extract() == EXIT_OKAY
+    assert tmpdir.join("variables.tf").read().count("variable") == len(
+        expected)
+
+
+def test_scan_mmap(tmpdir, monkeypatch):
+    """Test that memory-mapped files scan the same as read files."""
+    tf_file = tmpdir.join("main.tf")
+    tf_file.write_binary(
+        b'# var.commented\n' + b'a = var.alpha\n' * 1000
+        + b'variable "b\xc3\xa9ta" {}\nc = "${var.gamma}"\n')
+    expected = find_vars_in_files([str(tf_file)])
+
+    monkeypatch.setattr(scratchrelaxtv, "MMAP_THRESHOLD", 1)
+
+    assert find_vars_in_files([str(tf_file)]) == expected == [
+        "alpha", "gamma"]
+    assert find_vars_in_files([str(tf_file)], "variable") == [u"b\xe9ta"]
+
+
+def test_hcl_index():
+    """Test indexing declarations and uses with the HCL2 lexer."""
+    index = hcl.VariableIndex().add(
+        'variable "name" {\n'
+        '  type = string\n'
+        '  validation {\n'
+        '    condition = var.name != "var.literal"\n'
+        '  }\n'
+        '}\n'
+        '# var.commented\n'
+        'a = "${var.interpolated}"\n'
+        'b = <<-EOT\n'
+        '  %{ if var.flag }on%{ endif } $${var.escaped}\n'
+        '  EOT\n', "main.tf")
+
+    declaration = index.declarations["name"]
+    assert declaration.location == hcl.Location("main.tf", 1, 1)
+    assert declaration.attributes == ("type", "validation")
+    assert list(index.usages) == ["name", "interpolated", "flag"]
+    assert index.usages["flag"] == [hcl.Location("main.tf", 10, 9)]
+    assert index.missing() == ["interpolated", "flag"]
+
+
+def test_check_hcl_parser():
+    """Test checking for missing variables with the HCL2 lexer."""
+    with change_dir("tests"):
+        args = cli.parse_args([
+            "-c", "--parser", "hcl",
+            "-i", "main_missing.tf",
+            "-o", "variables_missing.tf",
+        ])
+
+        checker = Checker(args)
+        missing = checker.find_missing()
+
+        assert missing == {'main': ["create"], 'var': ["extra_var"]}
+        assert checker.index.declarations["extra_var"].attributes == (
+            "description", "type", "default")
+
+
+def test_check_hcl_parser_encoding(tmpdir):
+    """Test that the HCL2 lexer reads files as UTF-8, whatever the bytes."""
+    tmpdir.join("main.tf").write_binary(
+        b'a = var.alpha # caf\xc3\xa9 \xff\n')
+    tmpdir.join("variables.tf").write_binary(
+        b'variable "alpha" {\n  description = "\xe9"\n}\n')
+    args = cli.parse_args(["-c", "--parser", "hcl", "-I", str(tmpdir)])
+
+    assert Checker(args).find_missing() == {'main': [], 'var': []}
+
+
+def test_update(tmpdir):
+    """Test merging new vars into an existing variables.tf in place."""
+    tmpdir.join("main.tf").write("a = var.alpha\nc = var.gamma\n")
+    output = tmpdir.join("variables.tf")
+    kept = ('# hand-written\r\nvariable "alpha" {\r\n'
+            '  description = "caf\xe9"  # {\r\n}\r\n\r\n')
+    output.write_binary(kept.encode("utf_8") + b'variable "beta" {}\r\n')
+
+    args = cli.parse_args(["-u", "-I", str(tmpdir)])
+    assert VarExtractor(args).extract() == EXIT_OKAY
+    updated = output.read_binary().decode("utf_8")
+    assert updated.startswith(kept + 'variable "beta" {}\r\n\r\n')
+    assert updated.endswith('variable "gamma" {\r\n'
+                            '  description = ""\r\n'
+                            '  type        = string\r\n'
+                            '  default     = ""\r\n}\r\n')
+    assert not tmpdir.join("variables.1.tf").check()
+
+    args = cli.parse_args(["-u", "--prune", "drop", "-I", str(tmpdir)])
+    assert VarExtractor(args).extract() == EXIT_OKAY
+    assert output.read_binary().decode("utf_8") == updated.replace(
+        'variable "beta" {}\r\n\r\n', "")
+
+    tmpdir.join("main.tf").write("a = var.alpha\nd = var.delta\n")
+    args = cli.parse_args(["-cu", "--prune", "comment", "-I", str(tmpdir)])
+    Checker(args).extract()
+    updated = output.read_binary().decode("utf_8")
+    assert updated.startswith(kept)
+    assert '# variable "gamma" {\r\n#   description = ""\r\n' in updated
+    assert 'variable "delta" {\r\n' in updated
+
+
+def test_watch(tmpdir):
+    """Test regenerating only when the referenced variables change."""
+    main = tmpdir.join("main.tf")
+    main.write("a = var.alpha\n")
+    output = tmpdir.join("variables.tf")
+
+    args = cli.parse_args(["-w", "-I", str(tmpdir)])
+    watcher = watch.Watcher(VarExtractor(args))
+
+    assert watcher.poll()
+    assert 'variable "alpha"' in output.read()
+    assert not watcher.poll()
+
+    main.write("a = var.alpha\nb = 1\n")
+    assert not watcher.poll()
+
+    main.write("a = var.alpha\nb = var.beta\n")
+    assert watcher.poll()
+    assert 'variable "beta"' in output.read()
+    assert not tmpdir.join("variables.1.tf").check()
+
+    for argv in (["-w", "-R"], ["-w", "-A", "-R"], ["-cw", "--since", "HEAD"],
+                 ["-w", "--staged"]):
+        with pytest.raises(SystemExit):
+            cli.parse_args(argv)
+
+
+def test_watch_check(tmpdir):
+    """Test re-running the check when declarations change."""
+    tmpdir.join("main.tf").write("a = var.alpha\n")
+    variables = tmpdir.join("variables.tf")
+    variables.write("")
+
+    args = cli.parse_args(["-cw", "-I", str(tmpdir)])
+    watcher = watch.Watcher(Checker(args))
+
+    assert watcher.poll()
+    assert watcher.tf_vars == {'main': ["alpha"], 'var': []}
+
+    variables.write('variable "alpha" {}\n')
+    assert watcher.poll()
+    assert watcher.tf_vars == {'main': [], 'var': []}
+
+
+def test_watch_stub(tmpdir):
+    """Test restubbing when the providers change."""
+    main = tmpdir.join("main.tf")
+    main.write('variable "alpha" {}\n')
+    output = tmpdir.join("modstub.tf")
+
+    args = cli.parse_args(["-mw", "-I", str(tmpdir)])
+    watcher = watch.Watcher(StubMaker(args))
+
+    assert watcher.poll()
+    assert '    aws = "aws"\n' in output.read()
+
+    main.write('variable "alpha" {}\nprovider "google" {}\n')
+    assert watcher.poll()
+    assert '    google = "google"\n' in output.read()
+    assert '    aws = "aws"\n' not in output.read()
+    assert watcher.tf_vars == (["alpha"], ["google"])
+
+
+def test_startup():
+    """Test that importing the CLI stays cheap."""
+    # modules only some runs need must not be imported up front
+    deferred = ("concurrent.futures", "hashlib", "json", "logging.config",
+                "mmap", "scratchrelaxtv.hcl", "scratchrelaxtv.names",
+                "scratchrelaxtv.pipeline",
+                "scratchrelaxtv.server",
+                "tempfile")
+    output = subprocess.check_output([
+        sys.executable, "-c",
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import scratchrelaxtv.cli\n"
+        "print(time.perf_counter() - start)\n"
+        "print(' '.join(sys.modules))\n"], universal_newlines=True)
+    elapsed, modules = output.splitlines()
+
+    assert not set(deferred) & set(modules.split())
+    assert float(elapsed) < 0.5
+
+
+def test_configure_logging():
+    """Test that quiet logging drops info records."""
+    logger = logging.getLogger("scratchrelaxtv")
+    try:
+        scratchrelaxtv.configure_logging(quiet=True)
+        scratchrelaxtv.configure_logging(quiet=True)
+        assert len(logger.handlers) == 2
+        assert not logger.isEnabledFor(logging.INFO)
+        assert logger.isEnabledFor(logging.WARNING)
+
+        scratchrelaxtv.configure_logging()
+        assert logger.isEnabledFor(logging.DEBUG)
+    finally:
+        logger.handlers = [handler for handler in logger.handlers
+                           if isinstance(handler, logging.NullHandler)]
+        logger.setLevel(logging.NOTSET)
+        logger.propagate = True
+
+
+def test_removal_pruned(tmpdir, capsys):
+    """Test that ignored and excluded paths are not walked or removed."""
+    for path in ("a/modstub.tf", "a/b/variables.2.tf", ".terraform/modstub.tf",
+                 "vendor/modstub.tf", "a/keep/modstub.1.tf", "a/variables.tf"):
+        tmpdir.join(path).write("hello", ensure=True)
+
+    removed = remove_files(
+        str(tmpdir),
+        excludes=["# comment", "vendor/", "/a/keep"],
+        dry_run=True)
+
+    assert sorted(os.path.relpath(path, str(tmpdir)) for path in removed) == [
+        os.path.join("a", "b", "variables.2.tf"),
+        os.path.join("a", "modstub.tf")]
+    assert tmpdir.join("a/modstub.tf").check()
+    assert not capsys.readouterr().out
+
+    with change_dir(str(tmpdir)):
+        assert cli.run(cli.parse_args(
+            ["-r", "--dry-run", "--exclude", "vendor/"])) == EXIT_OKAY
+    assert len(capsys.readouterr().out.splitlines()) == 3
+    assert tmpdir.join("a/modstub.tf").check()
+
+    remove_files(str(tmpdir), excludes=["vendor/", "/a/keep"])
+
+    assert not tmpdir.join("a/modstub.tf").check()
+    assert not tmpdir.join("a/b/variables.2.tf").check()
+    assert tmpdir.join(".terraform/modstub.tf").check()
+    assert tmpdir.join("a/keep/modstub.1.tf").check()
+
+
+def test_library_api(tmpdir):
+    """Test extracting, checking and rendering without argparse or files."""
+    variables = tmpdir.join("variables.tf")
+    variables.write('variable "bucket" {}\nvariable "extra" {}\n')
+    main = 'bucket = var.bucket\nregion = var.region\n'
+
+    tf_vars = scratchrelaxtv.extract_vars(main, order="desc")
+    assert tf_vars == ["region", "bucket"]
+    assert scratchrelaxtv.check_vars(
+        main, variables_paths=[str(variables)]) == (["region"], ["extra"])
+    assert scratchrelaxtv.render_tfvars(tf_vars) == (
+        'region = "replace"\nbucket = "replace"\n')
+
+    with change_dir("tests"):
+        with open("modstub.tf", "r", encoding="utf_8") as file_handle:
+            assert scratchrelaxtv.render_modstub(
+                scratchrelaxtv.extract_vars(paths=["variables.tf"],
+                                            kind="variable"),
+                "tests") == file_handle.read()
+
+
+def test_write_output(tmpdir):
+    """Test atomic writes that leave identical files untouched."""
+    output = tmpdir.join("variables.tf")
+
+    assert scratchrelaxtv.write_output(str(output), "a\n")
+    os.utime(str(output), (1, 1))
+    assert not scratchrelaxtv.write_output(str(output), "a\n")
+    assert output.mtime() == 1
+
+    assert scratchrelaxtv.write_output(str(output), "b\n", append=True)
+    assert output.read() == "a\nb\n"
+    assert not tmpdir.listdir(lambda path: path.basename.startswith("."))
+
+    os.chmod(str(output), 0o640)
+    assert scratchrelaxtv.write_output(str(output), "c\n")
+    assert output.stat().mode & 0o777 == 0o640
+
+    # new files get the umask, from any number of threads at once
+    umask = os.umask(0o027)
+    try:
+        threads = [threading.Thread(target=lambda start: [
+            scratchrelaxtv.write_output(
+                str(tmpdir.join("{}.tf".format(start + i))), "a\n")
+            for i in range(50)], args=(start,))
+            for start in range(0, 400, 50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        os.umask(umask)
+    assert {path.stat().mode & 0o777 for path in tmpdir.listdir(
+        lambda path: path.basename[0].isdigit())} == {0o640}
+
+
+def test_next_filename(tmpdir):
+    """Test numbering past the highest existing generation."""
+    for name in ("variables.tf", "variables.2.tf", "variables.9.tf",
+                 "variables.x.tf", "other.12.tf"):
+        tmpdir.join(name).write("")
+
+    args = cli.parse_args(["-o", str(tmpdir.join("variables.tf"))])
+    extractor = VarExtractor(args)
+    extractor._find_non_existing_filename()   # pylint: disable=W0212
+
+    assert extractor.args.output == str(tmpdir.join("variables.10.tf"))
+
+
+def test_keep_generations(tmpdir):
+    """Test pruning numbered generations down to --keep."""
+    for index in range(1, 6):
+        tmpdir.join("modstub.{}.tf".format(index)).write("")
+    tmpdir.join("modstub.tf").write("")
+
+    args = cli.parse_args(["-m", "-k", "2", "-I", str(tmpdir)])
+    StubMaker(args).write_file()
+
+    assert sorted(path.basename for path in tmpdir.listdir("modstub*")) == [
+        "modstub.5.tf", "modstub.6.tf", "modstub.tf"]
+
+
+def test_check_recursive(tmpdir):
+    """Test checking every module in a tree with one report."""
+    tmpdir.join("good/main.tf").write("a = var.a\n", ensure=True)
+    tmpdir.join("good/variables.tf").write('variable "a" {}\n')
+    tmpdir.join("bad/main.tf").write("a = var.b\n", ensure=True)
+    tmpdir.join("bad/variables.tf").write('variable "c" {}\n')
+    tmpdir.join("bad/.terraform/x.tf").write("a = var.d\n", ensure=True)
+    report = tmpdir.join("report.json")
+
+    args = cli.parse_args([
+        "-cR", "-I", str(tmpdir), "--report", str(report)])
+
+    assert Checker(args).extract() == scratchrelaxtv.EXIT_NOT_OKAY
+    assert json.loads(report.read()) == {
+        "modules": [
+            {"module": str(tmpdir.join("bad")),
+             "missing": ["b"], "unused": ["c"]},
+            {"module": str(tmpdir.join("good")),
+             "missing": [], "unused": []}],
+        "problems": 1}
+
+    junit = scratchrelaxtv.render_report_junit(
+        scratchrelaxtv.check_modules([str(tmpdir.join("good"))]))
+    suite = ElementTree.fromstring(junit)
+    assert suite.attrib["tests"] == "1"
+    assert suite.attrib["failures"] == "0"
+
+
+def test_name_table(tmpdir, monkeypatch):
+    """Test interning names and checking modules in batches of files."""
+    table = names.NameTable()
+    postings = table.postings(["b", "a", "b"], ["a", "c"])
+    assert list(postings.used) == [0, 1, 0]
+    assert postings.used.itemsize == 4
+    assert len(table) == 3 and "c" in table and "d" not in table
+    assert table.intern("a") == 1
+    assert table.compare([postings, table.postings(["c"], ["d"])]) == (
+        ["b"], ["d"])
+
+    for module in ("m0", "m1", "m2"):
+        tmpdir.join(module, "main.tf").write(
+            "a = var.{0}\nb = var.shared\n".format(module), ensure=True)
+        tmpdir.join(module, "variables.tf").write('variable "shared" {}\n')
+    monkeypatch.setattr(scratchrelaxtv, "CHECK_BATCH_FILES", 3)
+    module_dirs = [str(tmpdir.join(module)) for module in ("m0", "m1", "m2")]
+    assert [list(batch) for batch in scratchrelaxtv._module_batches(
+        module_dirs)] == [module_dirs[:1], module_dirs[1:2], module_dirs[2:]]
+    results = scratchrelaxtv.check_modules(module_dirs, jobs=1)
+    assert [result.missing for result in results.values()] == [
+        ["m0"], ["m1"], ["m2"]]
+
+
+def test_all_artifacts(tmpdir):
+    """Test generating all of a module's files from one scan."""
+    tmpdir.join("main.tf").write(
+        'resource "aws_s3_bucket" "this" {\n'
+        '  bucket = var.bucket\n'
+        '  user_data = templatefile("${path.module}/tpl/init.sh", {})\n'
+        '}\n'
+        'data "google_project" "this" {}\n'
+        'data "terraform_remote_state" "vpc" {\n'
+        '  config = { region = var.region }\n'
+        '}\n'
+        '# resource "azurerm_thing" "gone" {}\n')
+    tmpdir.join("inputs.tf").write('variable "extra" {}\n')
+    tmpdir.join("tpl/init.sh").write("echo ${greeting}\n", ensure=True)
+
+    args = cli.parse_args(["-A", "-n", "app", "-I", str(tmpdir)])
+    assert cli.run(args) == EXIT_OKAY
+    assert tmpdir.join("variables.tf").read() == (
+        scratchrelaxtv.render_variables(["bucket", "region"]))
+    assert tmpdir.join("modstub.tf").read() == scratchrelaxtv.render_modstub(
+        ["extra", "bucket", "region"], "app",
+        providers=["aws", "google"])
+    assert 'providers = {\n    aws = "aws"\n    google = "google"\n' in (
+        tmpdir.join("modstub.tf").read())
+    assert tmpdir.join(".env").read() == (
+        scratchrelaxtv.render_env(["bucket", "region"]))
+    assert tmpdir.join("terraform.tfvars").read() == (
+        scratchrelaxtv.render_tfvars(["bucket", "region"]))
+    assert tmpdir.join("template_vars.tf").read() == (
+        scratchrelaxtv.render_template_vars(["greeting"]))
+
+    # the generated files are not scanned again
+    assert cli.run(cli.parse_args(["-A", "-I", str(tmpdir)])) == EXIT_OKAY
+    assert tmpdir.join("variables.1.tf").read() == (
+        scratchrelaxtv.render_variables(["bucket", "region"]))
+
+    args = cli.parse_args(["-mf", "-I", str(tmpdir)])
+    StubMaker(args).extract()
+    assert "    google = " in tmpdir.join("modstub.tf").read()
+    assert scratchrelaxtv.render_modstub([], "m", providers=()) == (
+        'module "m" {\n  source = "../m"\n\n}\n\n')
+
+
+def test_stream(tmpdir, monkeypatch, capsys):
+    """Test reading stdin and file lists, and writing stdout."""
+    text = ('a = var.alpha # var.hidden\n'
+            '/* b = var.hidden\n */ c = "s3://b/*" d = var.beta\n'
+            'e = var.alpha /* var.hidden */ f = var.gamma\n')
+    expected = scratchrelaxtv.scan(text)
+    # fed a character at a time, as found, but never a var commented out
+    found = [refs["var"] for refs in scratchrelaxtv.scan_stream(text)]
+    assert [names for names in found if names] == [
+        ["alpha"], ["beta"], ["alpha", "gamma"]]
+    assert found.index(["beta"]) < len(found) - 1
+    assert list(dict.fromkeys(sum(found, []))) == expected["var"]
+    found = [refs["var"] for refs in scratchrelaxtv.scan_stream(QUOTED_MAIN)]
+    assert sum(found, []) == scan(QUOTED_MAIN)["var"]
+    heredoc = "x = <<EOT\necho # ${var.b}\nEOT\ny = var.c\n"
+    found = [refs["var"] for refs in scratchrelaxtv.scan_stream(heredoc)]
+    assert [names for names in found if names] == [["b"], ["c"]]
+
+    monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(
+        io.BytesIO(text.encode("utf_8")), "utf_8"))
+    assert cli.run(cli.parse_args(["-e", "-i", "-", "-o", "-"])) == EXIT_OKAY
+    assert capsys.readouterr().out == scratchrelaxtv.render_env(
+        ["alpha", "beta", "gamma"])
+
+    tmpdir.join("a.tf").write("a = var.alpha\n")
+    tmpdir.join("b.tf").write('b = var.beta\nvariable "alpha" {}\n')
+    tmpdir.join("list").write_binary(b"\0".join(
+        str(tmpdir.join(name)).encode() for name in ("b.tf", "a.tf")))
+    argv = ["--files0-from", str(tmpdir.join("list")), "-o", "-"]
+    assert cli.run(cli.parse_args(argv + ["-t"])) == EXIT_OKAY
+    assert capsys.readouterr().out == 'beta = "replace"\nalpha = "replace"\n'
+    args = cli.parse_args(argv + ["-c"])
+    assert Checker(args).find_missing() == {"main": ["beta"], "var": []}
+
+
+def test_bench(tmpdir):
+    """Test generating a corpus and running the benchmarks on it."""
+    module_dirs = bench.generate_corpus(
+        str(tmpdir), variables=20, files=4, modules=2)
+    assert len(scratchrelaxtv.find_input_files(module_dirs)) == 6
+    assert scratchrelaxtv.check_modules(module_dirs)[module_dirs[0]] == (
+        [], [])
+
+    results = bench.run(variables=20, files=2)
+    assert "find_missing" in results["results"]
+    assert bench.compare(results, results) == []
+
+    slower = json.loads(json.dumps(results))
+    slower["results"]["scan"]["seconds"] = 2 * (
+        results["results"]["scan"]["seconds"] + 1)
+    assert [name for name, _, _ in bench.compare(results, slower)] == ["scan"]
+
+
+def test_server_stdio(tmpdir, cache_home):
+    """Test answering JSON-RPC requests with a warm cache."""
+    tmpdir.join("main.tf").write("a = var.alpha\nb = var.beta\n")
+    tmpdir.join("variables.tf").write('variable "alpha" {}\n')
+    requests = [
+        {"id": 1, "method": "check", "params": {
+            "paths": ["main.tf"], "variables_paths": ["variables.tf"],
+            "cwd": str(tmpdir)}},
+        {"id": 2, "method": "tfvars", "params": {"text": "a = var.a\n"}},
+        {"id": 3, "method": "modstub", "params": {
+            "paths": ["variables.tf"], "cwd": str(tmpdir)}},
+        {"id": 4, "method": "nope"},
+        {"method": "extract"},
+        {"id": 5, "method": "extract", "params": {"bogus": 1}},
+        {"id": 6, "method": "stats"},
+        {"id": 7, "method": "shutdown"},
+        {"id": 8, "method": "stats"},
+    ]
+    stdout = io.StringIO()
+    server.Server(VarCache()).serve_stdio(
+        io.StringIO("".join(json.dumps(request) + "\n"
+                            for request in requests)), stdout)
+    responses = [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    assert [response["id"] for response in responses] == [1, 2, 3, 4, 5, 6, 7]
+    assert responses[0]["result"] == {"missing": ["beta"], "unused": []}
+    assert responses[1]["result"]["content"] == 'a = "replace"\n'
+    assert 'source = "../' + tmpdir.basename + '"' in responses[2][
+        "result"]["content"]
+    assert responses[3]["error"]["code"] == server.METHOD_NOT_FOUND
+    assert responses[4]["error"]["code"] == server.INVALID_PARAMS
+    assert responses[5]["result"]["requests"] == 7
+    assert cache_home.join("scratchrelaxtv", "vars").listdir()
+
+
+def fail(**_):
+    """Stand in for a library function with a bug."""
+    raise RuntimeError("bug")
+
+
+def test_server_errors(monkeypatch):
+    """Test answering bad parameters and unexpected errors, and staying up."""
+    def answer(params):
+        return json.loads(daemon.handle(json.dumps(
+            {"id": 1, "method": "extract", "params": params})))["error"]
+
+    daemon = server.Server()
+    for params in ({"kind": "bogus"}, {"kind": ["var"]}, {"order": "up"},
+                   {"parser": "yacc"}):
+        assert answer(dict(params, text="")) == {
+            "code": server.INVALID_PARAMS,
+            "message": "{} must be one of {}".format(
+                *params, ", ".join(map(json.dumps, server.PARAM_CHOICES[
+                    next(iter(params))])))}
+
+    monkeypatch.setattr(scratchrelaxtv, "extract_vars", fail)
+    assert answer({"text": ""}) == {
+        "code": server.SERVER_ERROR, "message": "bug"}
+    assert daemon.running
+
+
+def test_server_stdio_logging(monkeypatch, capsys):
+    """Test that serving on stdin/stdout logs to stderr."""
+    monkeypatch.setattr(scratchrelaxtv.logger, "handlers", [])
+    monkeypatch.setattr(sys, "argv", ["scratchrelaxtv", "--serve"])
+    monkeypatch.setattr(sys, "stdin", io.StringIO(
+        json.dumps({"id": 1, "method": "extract",
+                    "params": {"text": "a = var.a\n"}}) + "\n"
+        + json.dumps({"id": 2, "method": "check"})))
+    monkeypatch.setattr(scratchrelaxtv, "check_vars", fail)
+    with pytest.raises(SystemExit):
+        cli.main()
+
+    captured = capsys.readouterr()
+    responses = [json.loads(line) for line in captured.out.splitlines()]
+    assert responses[0]["result"] == {"vars": ["a"]}
+    assert responses[1]["error"]["code"] == server.SERVER_ERROR
+    assert "Traceback" in captured.err
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="no Unix sockets")
+def test_server_socket(tmpdir):
+    """Test the client against a server on a Unix socket."""
+    tmpdir.join("main.tf").write("a = var.alpha\n")
+    path = str(tmpdir.join("relaxtv.sock"))
+    thread = threading.Thread(
+        target=server.Server().serve_socket, args=(path,))
+    thread.start()
+    try:
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.01)
+        assert server.request(path, "extract", paths=["main.tf"],
+                              cwd=str(tmpdir)) == {"vars": ["alpha"]}
+        with pytest.raises(server.ServerError):
+            server.request(path, "nope")
+    finally:
+        server.request(path, "shutdown")
+        thread.join(5)
+
+    assert not os.path.exists(path)
+
+
+def test_stub_graph(tmpdir, monkeypatch):
+    """Test stubbing every called module, redoing only changed ones."""
+    tmpdir.join("main.tf").write(
+        'module "app" {\n  source = "./modules/app"\n  name = "x"\n}\n'
+        'module "remote" {\n  source = "hashicorp/consul/aws"\n}\n')
+    tmpdir.join("modules/app/main.tf").write(
+        'variable "name" {}\nvariable "size" {\n  default = 1\n}\n'
+        'module "db" {\n  source = "../db"\n  name = var.name\n}\n',
+        ensure=True)
+    tmpdir.join("modules/db/variables.tf").write(
+        'variable "name" {}\n', ensure=True)
+    args = ["-m", "-R", "-I", str(tmpdir)]
+
+    assert StubMaker(cli.parse_args(args)).extract() == EXIT_OKAY
+    assert tmpdir.join("modules/app/modstub.tf").read() == (
+        'module "app" {\n  source = "./modules/app"\n\n'
+        '  providers = {\n    aws = "aws"\n  }\n\n'
+        '  name = "${local.name}"\n  size = "${local.size}"\n}\n\n')
+    assert 'source = "../db"' in tmpdir.join("modules/db/modstub.tf").read()
+
+    # unchanged modules are neither read nor rewritten
+    read = []
+    real_read_module = scratchrelaxtv.read_module
+    monkeypatch.setattr(scratchrelaxtv, "read_module", lambda *args: (
+        read.append(args[0]) or real_read_module(*args)))
+    assert StubMaker(cli.parse_args(args)).extract() == EXIT_OKAY
+    assert read == []
+
+    tmpdir.join("modules/db/variables.tf").write(
+        'variable "name" {}\nvariable "engine" {}\n')
+    assert StubMaker(cli.parse_args(args)).extract() != EXIT_OKAY
+    assert [os.path.basename(path) for path in read] == ["db"]
+    assert "engine" in tmpdir.join("modules/db/modstub.tf").read()
+
+
+def test_find_vars_deprecated():
+    """Test the deprecated find_vars(), and natural-sorted var finding."""
+    text = bench.generated_code(50, unique=12)
+    regex = scratchrelaxtv.BassExtractor.var_regex
+    with pytest.warns(DeprecationWarning):
+        tf_vars = scratchrelaxtv.BassExtractor.find_vars(text, regex)
+    assert tf_vars == ["input_{}".format(i) for i in range(12)]
+    assert scratchrelaxtv.compiled(regex) is scratchrelaxtv.compiled(regex)
+
+    assert scratchrelaxtv.extract_vars(text, order="desc", natural=True)[
+        :3] == ["input_11", "input_10", "input_9"]
+    assert set(bench.micro(100, repeat=1)) == {"scan"}
+
+
+def test_template_dirs(tmpdir, monkeypatch):
+    """Test extracting from a template glob, skipping binaries."""
+    tmpdir.join("tpl/a.tpl").write(
+        "${name}\n%{ for host in hosts ~}\n${host}\n%{ endfor ~}\n",
+        ensure=True)
+    tmpdir.join("tpl/sub/b.tpl").write_binary(
+        "${region} %{if enabled}".encode("utf_16"), ensure=True)
+    tmpdir.join("tpl/sub/blob.tpl").write_binary(b"${secret}\x00\xff")
+    tmpdir.join("tpl/sub/c.sh").write("${skipped}")
+    with change_dir(str(tmpdir)):
+        args = cli.parse_args(["--template", "-f", "-i", "tpl/**/*.tpl"])
+        assert TemplateExtractor(args).extract() == EXIT_OKAY
+        assert tmpdir.join("template_vars.tf").read() == (
+            scratchrelaxtv.render_template_vars(
+                ["name", "hosts", "region", "enabled"]))
+
+        args = cli.parse_args(["--template", "-f", "-I", "tpl"])
+        extractor = TemplateExtractor(args)
+        extractor.extract()
+        extractor.extract()
+        assert "skipped" in extractor.tf_vars
+        assert "secret" not in extractor.tf_vars
+
+    # only the head of a binary file is read
+    read = []
+
+    class Reader(io.BufferedReader):
+        """Record how much is read."""
+
+        def read(self, size=-1):
+            data = super().read(size)
+            read.append(len(data))
+            return data
+
+    blob = tmpdir.join("blob.tf")
+    blob.write_binary(b"\x00" + b"a = var.alpha\n" * 10000)
+    monkeypatch.setattr(scratchrelaxtv, "open", lambda name, mode: Reader(
+        io.FileIO(name, mode)), raising=False)
+    assert scratchrelaxtv._scan_path(str(blob), "hcl")[0]["var"] == []
+    assert sum(read) == scratchrelaxtv.SNIFF_SIZE
+
+
+def git(root, *args):
+    """Run git in root."""
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+         *args], cwd=str(root), check=True, stdout=subprocess.PIPE)
+
+
+def test_changed_only(tmpdir, monkeypatch):
+    """Test checking and extracting only the modules git reports changed."""
+    for name in ("one", "two"):
+        tmpdir.join(name, "main.tf").write("a = var.a\n", ensure=True)
+        tmpdir.join(name, "variables.tf").write('variable "a" {}\n')
+    git(tmpdir, "init", "-q")
+    git(tmpdir, "add", ".")
+    git(tmpdir, "commit", "-qm", "modules")
+    report = tmpdir.join("report.json")
+    args = ["-c", "-I", str(tmpdir), "--report", str(report)]
+    assert Checker(cli.parse_args(args + ["-R"])).extract() == EXIT_OKAY
+
+    checked = []
+    real_check_modules = scratchrelaxtv.check_modules
+    monkeypatch.setattr(scratchrelaxtv, "check_modules", lambda dirs, *args: (
+        checked.extend(dirs) or real_check_modules(dirs, *args)))
+    tmpdir.join("two", "templates", "user_data.tpl").write(
+        "${b}", ensure=True)
+    tmpdir.join("one", "main.tf").write("a = var.b\n")
+    git(tmpdir, "add", "one")
+    assert Checker(cli.parse_args(
+        args + ["--staged"])).extract() != EXIT_OKAY
+    assert checked == [str(tmpdir.join("one"))]
+    assert [module["module"] for module in json.loads(report.read())[
+        "modules"]] == [str(tmpdir.join("one")), str(tmpdir.join("two"))]
+
+    del checked[:]
+    assert Checker(cli.parse_args(args + ["--since", "HEAD"])).extract()
+    assert checked == [str(tmpdir.join("one")), str(tmpdir.join("two"))]
+
+    assert VarExtractor(cli.parse_args(
+        ["-f", "-I", str(tmpdir), "--staged"])).extract() == EXIT_OKAY
+    assert tmpdir.join("one", "variables.tf").read() == (
+        scratchrelaxtv.render_variables(["b"]))
+    assert VarExtractor(cli.parse_args(
+        ["-I", str(tmpdir.join("nowhere")), "--staged"])).extract() != (
+            EXIT_OKAY)
+
+
+def test_pipeline(tmpdir):
+    """Test extracting into many modules through the async pipeline."""
+    module_dirs = bench.generate_corpus(
+        str(tmpdir), variables=40, files=8, modules=4)
+    for module_dir in module_dirs:
+        os.remove(os.path.join(module_dir, "variables.tf"))
+
+    results = pipeline.run(pipeline.extract_modules(
+        module_dirs, jobs=2, cache=VarCache()))
+    assert list(results) == module_dirs
+    for module_dir, tf_vars in results.items():
+        assert tf_vars == scratchrelaxtv.extract_vars(
+            paths=scratchrelaxtv.find_input_files([module_dir]))
+        with open(os.path.join(module_dir, "variables.tf")) as file_handle:
+            assert file_handle.read() == scratchrelaxtv.render_variables(
+                tf_vars)
+
+    args = cli.parse_args(["-t", "-R", "-a", "-j", "3", "-I", str(tmpdir)])
+    assert EnvGenerator(args).extract() == EXIT_OKAY
+    assert VarExtractor(cli.parse_args(
+        ["-R", "-I", str(tmpdir)])).extract() == EXIT_OKAY
+    for module_dir in module_dirs:
+        assert sorted(os.listdir(module_dir))[-3:] == [
+            "terraform.tfvars", "variables.1.tf", "variables.tf"]
+
+    module_dir = tmpdir.mkdir("typed")
+    module_dir.join("main.tf").write("count = var.instances\nb = var.b\n")
+    variables = module_dir.join("variables.tf")
+    variables.write_binary(b'variable "b" {}\r\n\r\nvariable "gone" {}\r\n')
+    args = cli.parse_args(["-R", "--infer", "-u", "--prune", "drop",
+                           "-I", str(module_dir)])
+    assert VarExtractor(args).extract() == EXIT_OKAY
+    updated = variables.read_binary().decode("utf_8")
+    assert updated.startswith('variable "b" {}\r\n')
+    assert 'variable "instances" {\r\n' in updated
+    assert "type        = number\r\n" in updated
+    assert "gone" not in updated
+    assert not module_dir.join("variables.1.tf").check()
+
+    variables.remove()
+    assert VarExtractor(args).extract() == EXIT_OKAY
+    assert "type        = number\n" in variables.read()
+
+
+def test_pipeline_errors(tmpdir, monkeypatch):
+    """Test that a module that cannot be read does not stop the others."""
+    for name in ("m1", "m2", "m3"):
+        tmpdir.join(name, "main.tf").write("a = var.alpha\n", ensure=True)
+    tmpdir.join("m1").mkdir("old.tf")
+    scan_path = scratchrelaxtv._scan_path
+
+    def scan_or_fail(filename, *args):
+        if "m2" in filename:
+            raise PermissionError(13, "Permission denied", filename)
+        return scan_path(filename, *args)
+
+    monkeypatch.setattr(scratchrelaxtv, "_scan_path", scan_or_fail)
+    args = cli.parse_args(["-R", "-f", "--no-cache", "-j", "1",
+                           "-I", str(tmpdir)])
+    assert VarExtractor(args).extract() != EXIT_OKAY
+    assert tmpdir.join("m1", "variables.tf").check()
+    assert not tmpdir.join("m2", "variables.tf").check()
+    assert tmpdir.join("m3", "variables.tf").check()
+
+
+def test_infer_types(tmpdir):
+    """Test declaring vars with the types their uses suggest."""
+    tmpdir.join("main.tf").write(
+        'count = var.instances\nfor_each = var.buckets\n'
+        'zone = var.zones[0]\nname = var.settings.name\n'
+        'size = var.settings["size"]\ncount = var.create ? 1 : 0\n'
+        'tag = "${var.tag}"\n# count = var.ignored[0]\n')
+    with change_dir(str(tmpdir)):
+        args = cli.parse_args(["--infer", "-f"])
+        assert VarExtractor(args).extract() == EXIT_OKAY
+        declared = hcl.VariableIndex().add(tmpdir.join("variables.tf").read())
+        assert list(declared.declarations) == [
+            "instances", "buckets", "zones", "settings", "create", "tag"]
+        assert [line.split("=", 1)[1].strip()
+                for line in tmpdir.join("variables.tf").readlines()
+                if line.startswith("  type")] == [
+                    "number", "map(any)", "list(any)",
+                    "object({name = any})", "bool", "string"]
+
+        tmpdir.join("variables.tf").write('variable "tag" {}\n')
+        args = cli.parse_args(["-c", "-f", "--infer"])
+        Checker(args).extract()
+        assert "type        = number\n  default     = 0\n" in tmpdir.join(
+            "variables.tf").read()